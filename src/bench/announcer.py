@@ -0,0 +1,148 @@
+"""同じ秒に終わる500件のRTAの終了のお知らせを送る速さを測る
+
+前の実装と同じように1件ずつawait ch.send()する場合と、RTACogからAnnouncerで送る場合を比べる。
+送信はDiscordのAPIくらいの遅さにして、見つからない、権限がない、一時的に500番台を返す、
+とても遅いチャンネルを混ぜる。Announcerは全体40件/秒の上限を守るので、その分の時間はかかる。
+srcディレクトリで ``python -m bench.announcer`` のように実行する。
+"""
+import asyncio
+import datetime as dt
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fakes import FakeChannel, FakeGuild  # NOQA
+from bench.loadtest import Env  # NOQA
+from utils.rta_scheduler import RTAEventType  # NOQA
+
+RTAS = 500
+LATENCY = 0.08
+MISSING = 0.02
+FORBIDDEN = 0.02
+FLAKY = 0.05
+SLOW_CHANNELS = 2
+SLOW_LATENCY = 5.0
+
+
+@dataclass
+class BenchChannel(FakeChannel):
+    latency: float = LATENCY
+    forbidden: bool = False
+    failures: int = 0
+    delivered_at: float | None = None
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.forbidden:
+            raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), "Missing Access")
+        if self.failures:
+            self.failures -= 1
+            raise discord.DiscordServerError(SimpleNamespace(status=503, reason="Unavailable"), "")
+        self.delivered_at = time.perf_counter()
+        await super().send(content, **kwargs)
+
+
+def make_channels() -> tuple[list[BenchChannel], dict[int, BenchChannel]]:
+    """全部のチャンネルと、見つかるチャンネルの辞書"""
+    random.seed(0)
+    channels = [BenchChannel(guild=FakeGuild()) for _ in range(RTAS)]
+    found = {}
+    for i, ch in enumerate(channels):
+        r = random.random()
+        if i < SLOW_CHANNELS:
+            ch.latency = SLOW_LATENCY
+        elif r < MISSING:
+            continue
+        elif r < MISSING + FORBIDDEN:
+            ch.forbidden = True
+        elif r < MISSING + FORBIDDEN + FLAKY:
+            ch.failures = 1
+        found[ch.id] = ch
+    return channels, found
+
+
+def report(label: str, start: float, handled: float, found: dict[int, BenchChannel]):
+    delivered = sorted(i.delivered_at - start for i in found.values() if i.delivered_at is not None)
+    expected = sum(1 for i in found.values() if not i.forbidden)
+    print(
+        f"{label}: scheduler free after {handled - start:.2f}s, "
+        f"delivered {len(delivered)}/{expected}, "
+        f"p50 {statistics.median(delivered):.2f}s, "
+        f"p99 {delivered[min(int(len(delivered) * 0.99), len(delivered) - 1)]:.2f}s, "
+        f"last {delivered[-1]:.2f}s"
+    )
+
+
+async def sequential(rows, found: dict[int, BenchChannel]):
+    """前の実装: スケジューラの中で1件ずつ送り、失敗したらその件は諦める"""
+    start = time.perf_counter()
+    for row in rows:
+        ch = found.get(row["channel_id"])
+        try:
+            if ch is None:
+                raise Exception
+            await ch.send(embeds=[discord.Embed(title="終わった *!!!*")])
+        except Exception:
+            pass
+    report("sequential", start, time.perf_counter(), found)
+
+
+async def dispatcher(env: Env, rows, found: dict[int, BenchChannel]):
+    rta = env.rta
+    rta.announcer.resolve = found.get
+    start = time.perf_counter()
+    for row in rows:
+        await rta.check_rta(RTAEventType.END, row)
+    handled = time.perf_counter()
+    await rta.announcer.join()
+    report("announcer", start, handled, found)
+
+
+async def add_rtas(env: Env, channels: list[BenchChannel]):
+    date = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=60)
+    rows = []
+    for ch in channels:
+        ctx = SimpleNamespace(
+            guild_id=ch.guild.id, channel_id=ch.id,  # type: ignore
+            user=SimpleNamespace(id=1), created_at=dt.datetime.now(dt.timezone.utc),
+        )
+        rta_id = await env.db.add_rta(date, ctx)
+        rows.append((await env.db.get_rta(rta_id))[0])
+    return rows
+
+
+async def main():
+    env = Env()
+    await env.start()
+    try:
+        channels, found = make_channels()
+        print(
+            f"{RTAS} RTAs: {RTAS - len(found)} missing, "
+            f"{sum(i.forbidden for i in found.values())} forbidden, "
+            f"{sum(i.failures for i in found.values())} flaky, {SLOW_CHANNELS} slow ({SLOW_LATENCY}s)"
+        )
+        rows = await add_rtas(env, channels)
+        await sequential(rows, found)
+
+        channels, found = make_channels()
+        rows = await add_rtas(env, channels)
+        await dispatcher(env, rows, found)
+    finally:
+        await env.close()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as d:
+        # dbディレクトリを一時ディレクトリに作らせる
+        os.chdir(d)
+        asyncio.run(main())
@@ -0,0 +1,163 @@
+"""複数のプロセスで同じDBを使い、RTAの開始/終了が重複せずに処理されるか確かめる
+
+PROCESSES個のプロセスがSHARD_COUNT個のシャードを分けて受け持ち、
+RTAClusterでリーダーを決めて、開始/終了をサーバーを受け持つプロセスに渡す。
+途中でリーダーのプロセスを強制終了し、同じシャードで起動し直す(監視ツールが再起動する想定)。
+終了していないRTAがあるか、開始/終了が重複したら終了コード1で終わる。
+(リーダーが決まるのが遅れて終了時刻を過ぎた開始は飛ばすので、開始の数は確かめない)
+srcディレクトリで ``python -m bench.cluster`` のように実行する。
+"""
+import asyncio
+import datetime as dt
+import multiprocessing as mp
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db  # NOQA
+from utils.cluster import RTACluster  # NOQA
+from utils.rta_scheduler import RTAEventType, RTAScheduler  # NOQA
+
+PROCESSES = 3
+SHARD_COUNT = 6
+RTAS = 60
+MARGIN = 1.0
+TTL = 1.5
+KILL_AFTER = 3.0
+
+
+async def _worker(path: str, shard_ids: list[int], out: mp.Queue):
+    adb = db.AsyncBotDB(path)
+    active: set[int] = set()
+    scheduler: RTAScheduler | None = None
+
+    async def handle(event: RTAEventType, row: sqlite3.Row):
+        # RTACog.handle_rtaの代わりに、処理したことだけを親に伝える
+        if event is RTAEventType.START:
+            if row["id"] not in active:
+                active.add(row["id"])
+                if await adb.start_rta(row["id"]):
+                    out.put(("start", row["id"], shard_ids, time.time()))
+        elif event is RTAEventType.END:
+            active.discard(row["id"])
+            if await adb.finish_rta(row["id"], []):
+                out.put(("end", row["id"], shard_ids, time.time()))
+
+    async def check(event: RTAEventType, row: sqlite3.Row):
+        if not await cluster.forward(event.value, row["guild_id"], row["id"]):
+            await handle(event, row)
+
+    async def on_leader(leader: bool):
+        nonlocal scheduler
+        if scheduler is not None:
+            scheduler.stop()
+        if leader:
+            scheduler = RTAScheduler(check, margin=MARGIN)
+            for i in await adb.get_all_rta():
+                scheduler.add(i)
+            scheduler.start()
+        out.put(("leader" if leader else "follower", None, shard_ids, time.time()))
+
+    async def on_event(event: str, rta_id: int):
+        rows = await adb.get_rta(rta_id)
+        if rows:
+            await handle(RTAEventType(event), rows[0])
+
+    cluster = RTACluster(
+        adb, shard_ids, SHARD_COUNT, on_leader, on_event,
+        ttl=TTL, interval=TTL / 5, poll_interval=0.1,
+    )
+    cluster.start()
+    await asyncio.Event().wait()
+
+
+def worker(path: str, shard_ids: list[int], out: mp.Queue):
+    asyncio.run(_worker(path, shard_ids, out))
+
+
+def seed(path: str, start: float):
+    conn = sqlite3.connect(path)
+    db.init_db(conn)
+    bot_db = db.BotDB(conn)
+    random.seed(0)
+    for i in range(RTAS):
+        ctx = SimpleNamespace(
+            guild_id=random.getrandbits(63), channel_id=1,
+            user=SimpleNamespace(id=1), created_at=SimpleNamespace(timestamp=lambda: 0),
+        )
+        date = dt.datetime.fromtimestamp(start + 2 + i * 0.1)
+        bot_db.add_rta(date, ctx)  # type: ignore
+    conn.close()
+
+
+def main() -> bool:
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    shards = [list(range(SHARD_COUNT))[i::PROCESSES] for i in range(PROCESSES)]
+    with tempfile.TemporaryDirectory() as d:
+        path = str(Path(d) / "cluster.db")
+        start = time.time()
+        seed(path, start)
+        procs = [ctx.Process(target=worker, args=(path, i, out)) for i in shards]
+        for i in procs:
+            i.start()
+
+        events = []
+        leader: int | None = None
+        killed_at: float | None = None
+        deadline = start + 2 + RTAS * 0.1 + MARGIN + TTL + 5
+        while time.time() < deadline:
+            try:
+                event = out.get(timeout=0.1)
+            except Exception:
+                event = None
+            if event is not None:
+                events.append(event)
+                if event[0] == "leader":
+                    leader = shards.index(event[2])
+            if killed_at is None and leader is not None and time.time() - start > KILL_AFTER:
+                # リーダーを落として、同じシャードで起動し直す
+                procs[leader].kill()
+                procs[leader].join()
+                killed_at = time.time()
+                procs[leader] = ctx.Process(target=worker, args=(path, shards[leader], out))
+                procs[leader].start()
+            if sum(1 for i in events if i[0] == "end") == RTAS:
+                break
+        for i in procs:
+            i.kill()
+            i.join()
+
+    starts = Counter(i[1] for i in events if i[0] == "start")
+    ends = Counter(i[1] for i in events if i[0] == "end")
+    leaders = [(shards.index(i[2]), round(i[3] - start, 2)) for i in events if i[0] == "leader"]
+    print(f"{PROCESSES} processes, {SHARD_COUNT} shards, {RTAS} RTAs")
+    print(f"leaders (process, at): {leaders}, killed at {round((killed_at or start) - start, 2)}")
+    print(
+        f"ends: {len(ends)}/{RTAS} (duplicates {sum(v - 1 for v in ends.values())}), "
+        f"starts: {len(starts)}/{RTAS} (duplicates {sum(v - 1 for v in starts.values())})"
+    )
+    handled = Counter(shards.index(i[2]) for i in events if i[0] in ("start", "end"))
+    print(f"events handled per process: {dict(sorted(handled.items()))}")
+
+    ok = True
+    if len(ends) != RTAS:
+        print(f"NG: 終了していないRTAが{RTAS - len(ends)}件あります", file=sys.stderr)
+        ok = False
+    for name, counts in (("開始", starts), ("終了", ends)):
+        duplicates = sum(v - 1 for v in counts.values())
+        if duplicates:
+            print(f"NG: {name}が{duplicates}件重複しました", file=sys.stderr)
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
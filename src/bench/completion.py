@@ -0,0 +1,57 @@
+"""オートコンプリートの候補検索のマイクロベンチマーク
+
+10,000件の候補に対して1文字ずつ入力したときの1回あたりの時間を比べる。
+naiveは以前の_candidateと同じ方法で、順位付けもsubsequenceの一致もしない。
+srcディレクトリで ``python -m bench.completion`` のように実行する。
+"""
+import random
+import string
+import time
+
+from utils.completion import CompletionEngine
+
+N = 10_000
+WORDS = ["anime", "real", "mix", "diffusion", "xl", "pony", "v2", "turbo", "lora", "style"]
+QUERIES = ["himawari", "animemix", "realxl", "dfsn"]
+
+
+def naive(text: str, candidates: list[str]) -> list[str]:
+    # 以前の_candidateと同じ方法
+    return [i for i in candidates if text.lower() in i.lower()]
+
+
+def make_names() -> list[str]:
+    random.seed(0)
+    names = []
+    for _ in range(N):
+        parts = random.sample(WORDS, 2)
+        suffix = "".join(random.choices(string.ascii_lowercase, k=4))
+        names.append(f"{parts[0].title()}-{parts[1]}_{suffix}-v{random.randint(1, 9)}")
+    names[1234] = "HimawariMix-v8"
+    return names
+
+
+def bench(name: str, search) -> None:
+    calls = 0
+    s = time.perf_counter()
+    for q in QUERIES:
+        for n in range(1, len(q) + 1):
+            search(q[:n])
+            calls += 1
+    elapsed = (time.perf_counter() - s) / calls * 1000
+    print(f"{name:>10}: {elapsed:.3f}ms/keystroke")
+
+
+def main():
+    names = make_names()
+    bench("naive", lambda q: naive(q, names))
+    no_cache = CompletionEngine(names, cache_size=0)
+    bench("no cache", lambda q: no_cache.search(q))
+    engine = CompletionEngine(names)
+    bench("engine", lambda q: engine.search(q))
+    print("himawari ->", engine.search("himawari")[:3])
+    print("dfsn ->", engine.search("dfsn")[:3])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""BotDBとAsyncBotDBで、ランキング書き込み中のイベントループの遅延を比べる
+
+srcディレクトリで ``python -m bench.db_loop_lag`` のように実行する。
+"""
+import asyncio
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import db
+
+WRITES = 2000
+TICK = 0.001
+
+
+async def measure_lag(stop: asyncio.Event, lags: list[float]):
+    while not stop.is_set():
+        s = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - s - TICK)
+
+
+def fake_interaction():
+    return SimpleNamespace(
+        guild_id=1,
+        channel_id=1,
+        user=SimpleNamespace(id=1),
+        created_at=db.datetime.now(),
+    )
+
+
+async def run(name: str, write):
+    stop = asyncio.Event()
+    lags: list[float] = []
+    ticker = asyncio.create_task(measure_lag(stop, lags))
+    s = time.perf_counter()
+    await asyncio.gather(*(write(i) for i in range(WRITES)))
+    elapsed = time.perf_counter() - s
+    stop.set()
+    await ticker
+    lags.sort()
+    print(
+        f"{name:>10}: {WRITES / elapsed:8.0f} writes/s, "
+        f"lag p50={statistics.median(lags) * 1000:.2f}ms "
+        f"p99={lags[int(len(lags) * 0.99)] * 1000:.2f}ms "
+        f"max={lags[-1] * 1000:.2f}ms"
+    )
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as d:
+        sync_db = db.BotDB(sqlite3.connect(Path(d, "sync.sqlite")))
+        rta_id = sync_db.add_rta(db.datetime.now(), fake_interaction())  # type: ignore
+
+        async def sync_write(i):
+            sync_db.append_ranking(rta_id, i, i / 1000)
+        await run("BotDB", sync_write)
+        sync_db.db.close()
+
+        async_db = db.AsyncBotDB(Path(d, "async.sqlite"))
+        rta_id = await async_db.add_rta(db.datetime.now(), fake_interaction())
+
+        async def async_write(i):
+            await async_db.append_ranking(rta_id, i, i / 1000)
+        await run("AsyncBotDB", async_write)
+        async_db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""履歴が増えてもランキング系のクエリの時間が変わらないことを確認する
+
+srcディレクトリで ``python -m bench.db_ranking_scale [最大行数]`` のように実行する。
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import db
+
+USERS_PER_RTA = 100
+CHANNELS = 1000
+QUERIES = 500
+
+
+def grow(conn: sqlite3.Connection, start: int, stop: int):
+    """rta_rankingがstop行になるまでRTAと記録を追加する"""
+    rtas = []
+    ranks = []
+    for rta_id in range(start // USERS_PER_RTA, stop // USERS_PER_RTA):
+        ch = rta_id % CHANNELS
+        rtas.append((rta_id, ch // 10, ch, 0, float(rta_id * 120), 0))
+        ranks.extend(
+            (rta_id, user, random.uniform(-15, 15)) for user in range(USERS_PER_RTA)
+        )
+    with conn:
+        conn.executemany("INSERT INTO rta_db VALUES (?,?,?,?,?,?);", rtas)
+        conn.executemany("INSERT INTO rta_ranking VALUES (?,?,?);", ranks)
+
+
+def timeit(func) -> float:
+    s = time.perf_counter()
+    for _ in range(QUERIES):
+        func()
+    return (time.perf_counter() - s) / QUERIES * 1e6
+
+
+def main(limit: int):
+    with tempfile.TemporaryDirectory() as d:
+        bot_db = db.BotDB(sqlite3.connect(Path(d, "bench.sqlite")))
+        rows = 0
+        size = 10_000
+        print(f"{'rows':>10} {'get_ranking':>12} {'high_score':>12} {'near_rta':>12} {'upsert':>12}")
+        while size <= limit:
+            grow(bot_db.db, rows, size)
+            rows = size
+            n = rows // USERS_PER_RTA
+            ranking = timeit(lambda: bot_db.get_ranking(random.randrange(n)))
+            high = timeit(
+                lambda: bot_db.get_high_score(random.randrange(n), random.randrange(USERS_PER_RTA))
+            )
+            near = timeit(
+                lambda: bot_db.get_near_rta(random.randrange(n) * 120, random.randrange(CHANNELS))
+            )
+            upsert = timeit(
+                lambda: bot_db.append_ranking(
+                    random.randrange(n), random.randrange(USERS_PER_RTA), random.uniform(-15, 15)
+                )
+            )
+            print(f"{rows:>10} {ranking:>10.1f}us {high:>10.1f}us {near:>10.1f}us {upsert:>10.1f}us")
+            size *= 10
+        bot_db.db.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
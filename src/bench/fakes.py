@@ -0,0 +1,116 @@
+"""負荷試験用のdiscord.Interactionとdiscord.Messageの偽物
+
+コグが使う属性とメソッドだけを持ち、送った内容と返信までの時間を記録する。
+Discordには何も送らない。
+"""
+import datetime as dt
+import itertools
+import time
+from dataclasses import dataclass, field
+
+_ids = itertools.count(10 ** 17)
+
+
+def snowflake() -> int:
+    return next(_ids)
+
+
+@dataclass
+class FakeUser:
+    id: int = field(default_factory=snowflake)
+    bot: bool = False
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+@dataclass
+class FakeGuild:
+    id: int = field(default_factory=snowflake)
+    filesize_limit: int = 25 * 1024 ** 2
+
+
+@dataclass
+class FakeChannel:
+    id: int = field(default_factory=snowflake)
+    guild: FakeGuild | None = None
+    sent: list[dict] = field(default_factory=list)
+
+    def is_nsfw(self) -> bool:
+        return False
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append({"content": content, **kwargs})
+
+
+class FakeResponse:
+    """InteractionResponseの偽物。最初の応答の時刻を覚えておく"""
+    def __init__(self, interaction: "FakeInteraction") -> None:
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    def _respond(self, **kwargs):
+        if self._done:
+            raise RuntimeError("This interaction has already been responded to before")
+        self._done = True
+        self._interaction.responded_at = time.perf_counter()
+        self._interaction.messages.append(kwargs)
+
+    async def send_message(self, content=None, **kwargs):
+        self._respond(content=content, **kwargs)
+
+    async def edit_message(self, **kwargs):
+        self._respond(**kwargs)
+
+    async def defer(self, **kwargs):
+        self._respond()
+
+
+class FakeInteraction:
+    """コマンドやオートコンプリートに渡すInteractionの偽物
+
+    Args:
+        user (FakeUser): 実行したユーザー
+        channel (FakeChannel): 実行したチャンネル
+    """
+    def __init__(self, user: FakeUser, channel: FakeChannel) -> None:
+        self.id = snowflake()
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id if channel.guild else None
+        self.created_at = dt.datetime.now(dt.timezone.utc)
+        self.extras: dict = {}
+        self.response = FakeResponse(self)
+        self.created = time.perf_counter()
+        self.responded_at: float | None = None
+        self.finished_at: float | None = None
+        self.messages: list[dict] = []
+
+    async def edit_original_response(self, **kwargs):
+        if not self.response.is_done():
+            raise RuntimeError("Unknown interaction")
+        self.finished_at = time.perf_counter()
+        self.messages.append(kwargs)
+
+
+class FakeMessage:
+    """on_messageに渡すMessageの偽物。replyの時刻を覚えておく"""
+    def __init__(self, author: FakeUser, channel: FakeChannel, content: str = "") -> None:
+        self.id = snowflake()
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.created_at = dt.datetime.now(dt.timezone.utc)
+        self.replies: list[dict] = []
+        self.replied_at: float | None = None
+
+    async def reply(self, content=None, **kwargs):
+        self.replied_at = time.perf_counter()
+        self.replies.append({"content": content, **kwargs})
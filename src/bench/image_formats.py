@@ -0,0 +1,52 @@
+"""画像の形式ごとの変換時間と送信サイズを比べる
+
+1024x1024の画像を、webuiから来たPNGのまま・最適化PNG・WebP・JPEGにしたときの
+時間とバイト数を測る。srcディレクトリで ``python -m bench.image_formats`` のように実行する。
+"""
+import base64
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from utils.image_output import ImageFormat, encode
+
+SIZE = 1024
+ROUNDS = 3
+
+
+def make_image() -> str:
+    # 生成画像っぽく、グラデーションと図形とノイズを混ぜる
+    img = Image.linear_gradient("L").resize((SIZE, SIZE)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for i in range(0, SIZE, 64):
+        draw.ellipse((i, i // 2, i + 300, i // 2 + 200), fill=(i % 255, 120, 255 - i % 255))
+    img = img.filter(ImageFilter.GaussianBlur(3))
+    noise = Image.effect_noise((SIZE, SIZE), 40).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    buf = BytesIO()
+    img.save(buf, format="png")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def main():
+    image = make_image()
+    print(f"{'format':>10} {'time':>10} {'bytes':>12}")
+    for fmt in ImageFormat:
+        s = time.perf_counter()
+        for _ in range(ROUNDS):
+            encoded = encode(image, fmt)
+        elapsed = (time.perf_counter() - s) / ROUNDS * 1000
+        print(f"{fmt.value:>10} {elapsed:>8.1f}ms {len(encoded.data):>12,}")
+
+    # 以前と同じくPNGにそのままエンコードし直す場合
+    s = time.perf_counter()
+    for _ in range(ROUNDS):
+        buf = BytesIO()
+        Image.open(BytesIO(base64.b64decode(image))).save(buf, format="png")
+    elapsed = (time.perf_counter() - s) / ROUNDS * 1000
+    print(f"{'re-encode':>10} {elapsed:>8.1f}ms {len(buf.getvalue()):>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""参加者が多いRTAで途中経過(/rta_standings)を出す速さを測る
+
+Leaderboardと、毎回並べ直す方法、終了時と同じDBのget_rankingを比べる。
+srcディレクトリで ``python -m bench.leaderboard`` のように実行する。
+"""
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import db
+from utils.leaderboard import Leaderboard
+
+PARTICIPANTS = 100_000
+UPDATES = 200_000
+QUERIES = 200
+
+
+def timed(label: str, n: int, func):
+    s = time.perf_counter()
+    for _ in range(n):
+        func()
+    elapsed = time.perf_counter() - s
+    print(f"{label}: {elapsed / n * 1e6:.2f}us/op ({n} ops, {elapsed:.2f}s)")
+
+
+def main():
+    random.seed(0)
+    records = [(i, round(random.uniform(-60, 60), 3)) for i in range(PARTICIPANTS)]
+
+    s = time.perf_counter()
+    board = Leaderboard(records)
+    print(f"build {PARTICIPANTS} participants: {time.perf_counter() - s:.2f}s")
+    updates = [
+        (random.randrange(PARTICIPANTS), round(random.uniform(-60, 60), 3))
+        for _ in range(UPDATES)
+    ]
+    it = iter(updates)
+    timed("submit", UPDATES, lambda: board.submit(*next(it)))
+
+    def standings():
+        board.top(10)
+        board.rank(random.randrange(PARTICIPANTS))
+    timed("standings (Leaderboard)", QUERIES, standings)
+
+    best = dict(board)
+
+    def resort():
+        ranking = sorted(best.items(), key=lambda x: abs(x[1]))
+        ranking[:10]
+        user = random.randrange(PARTICIPANTS)
+        next(i for i, (u, _) in enumerate(ranking) if u == user)
+    timed("standings (sort every time)", QUERIES, resort)
+
+    with tempfile.TemporaryDirectory() as d:
+        conn = sqlite3.connect(Path(d) / "bench.db")
+        db.init_db(conn)
+        bot_db = db.BotDB(conn)
+        bot_db.append_rankings([(1, u, diff) for u, diff in best.items()])
+        timed("standings (get_ranking)", 20, lambda: bot_db.get_ranking(1))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
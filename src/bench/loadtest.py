@@ -0,0 +1,336 @@
+"""実際のコグを偽物のInteractionとMessage、スタブのwebuiで動かす負荷試験
+
+シナリオごとにp50/p99の遅延、スループット、イベントループの遅れをJSONで出力する。
+コミットごとに保存しておけば ``--compare`` で比べられる。
+srcディレクトリで ``python -m bench.loadtest`` のように実行する。
+
+    python -m bench.loadtest --out before.json
+    python -m bench.loadtest --scenario rta_messages --compare before.json
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import discord
+from discord.ext import commands
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fakes import FakeChannel, FakeGuild, FakeInteraction, FakeMessage, FakeUser  # NOQA
+from bench.stub_webui import StubWebUI  # NOQA
+
+TICK = 0.01
+
+
+@dataclass
+class Result:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0.0
+    lags: list[float] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        lags = sorted(self.lags) or [0.0]
+        return {
+            "count": len(latencies),
+            "errors": self.errors,
+            "elapsed_s": round(self.elapsed, 3),
+            "throughput_per_s": round(len(latencies) / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+            "loop_lag_p50_ms": round(statistics.median(lags) * 1000, 2),
+            "loop_lag_p99_ms": round(_percentile(lags, 0.99) * 1000, 2),
+            "loop_lag_max_ms": round(lags[-1] * 1000, 2),
+        }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class Measure:
+    """withの中の経過時間とイベントループの遅れを測る"""
+    def __init__(self, result: Result) -> None:
+        self.result = result
+
+    async def __aenter__(self):
+        self._stop = asyncio.Event()
+        self._ticker = asyncio.create_task(self._tick())
+        self._start = time.perf_counter()
+        return self.result
+
+    async def __aexit__(self, *args):
+        self.result.elapsed = time.perf_counter() - self._start
+        self._stop.set()
+        await self._ticker
+
+    async def _tick(self):
+        while not self._stop.is_set():
+            s = time.perf_counter()
+            await asyncio.sleep(TICK)
+            self.result.lags.append(time.perf_counter() - s - TICK)
+
+
+class Env:
+    """コグを読み込んだBotとスタブのwebui"""
+    async def start(self):
+        from utils import sd_pool
+        from utils import stable_diffusion as sd
+
+        # オートコンプリートの候補が多いときを想定する
+        models = [sd.Defaults.MODEL] + [
+            f"model-{i:03d}-{random.choice(['anime', 'real', 'nsfw'])}" for i in range(500)
+        ]
+        self.stub = StubWebUI(generate_delay=0.05, switch_delay=0.2, models=models)
+        port = await self.stub.start()
+        sd_pool.pool = sd_pool.BackendPool([sd.ModelsAPI(port=port)], max_per_user=1000)
+        sd_pool.pool.start()
+        while not sd_pool.pool.ready:
+            await asyncio.sleep(0.05)
+        self.pool = sd_pool.pool
+
+        self.bot = commands.Bot(command_prefix="!", intents=discord.Intents.default())
+        await self.bot.load_extension("cogs.common")
+        await self.bot.load_extension("cogs.generate_image")
+        from cogs import common, generate_image
+
+        # 学校のスケジュールの先読みは外に出ていくので止める
+        common.schedule_cache.stop()
+        self.db = common.main_db
+        self.rta = self.bot.get_cog("RTACog")
+        self.generate_image = generate_image
+        group = self.bot.tree.get_command("sd")
+        self.sd_group = group
+        self.txt2img = group.get_command("txt2img")  # type: ignore
+        self.guild = FakeGuild()
+        self.channel = FakeChannel(guild=self.guild)
+
+    async def close(self):
+        await self.bot.unload_extension("cogs.generate_image")
+        await self.bot.unload_extension("cogs.common")
+        await self.pool.close()
+        await self.stub.stop()
+        from db import close_shared_db
+        close_shared_db()
+        from utils import http
+        await http.client.close()
+
+    def interaction(self, user: FakeUser | None = None) -> FakeInteraction:
+        return FakeInteraction(user or FakeUser(), self.channel)
+
+
+async def rta_messages(env: Env, rate: int = 1000, seconds: float = 5, users: int = 200) -> Result:
+    """RTAの受付中のチャンネルに毎秒rate件のメッセージが来る"""
+    date = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=60)
+    rta_id = await env.db.add_rta(date, env.interaction())
+    row = (await env.db.get_rta(rta_id))[0]
+    env.rta.active.add(row)
+    people = [FakeUser() for _ in range(users)]
+    result = Result()
+
+    async def handle(message: FakeMessage):
+        s = time.perf_counter()
+        try:
+            await env.rta.on_message(message)
+        except Exception:
+            result.errors += 1
+            return
+        result.latencies.append(time.perf_counter() - s)
+
+    tasks = []
+    async with Measure(result):
+        start = time.perf_counter()
+        per_tick = rate * TICK
+        sent = 0
+        while sent < rate * seconds:
+            # 遅れても送る予定の数に追いつく
+            due = min(int((time.perf_counter() - start) / TICK * per_tick) + 1, int(rate * seconds))
+            for _ in range(due - sent):
+                message = FakeMessage(random.choice(people), env.channel, "a")
+                tasks.append(asyncio.create_task(handle(message)))
+            sent = due
+            await asyncio.sleep(TICK)
+        await asyncio.gather(*tasks)
+
+    env.rta.active.remove(rta_id)
+    await env.rta.ranking.flush()
+    await env.db.delete_rta(rta_id)
+    return result
+
+
+async def txt2img(env: Env, concurrency: int = 50) -> Result:
+    """別々のユーザーが同時に/sd txt2imgを実行する"""
+    result = Result()
+
+    async def run():
+        ctx = env.interaction()
+        try:
+            await env.txt2img.callback(env.sd_group, ctx, prompt="1girl")
+        except Exception:
+            result.errors += 1
+            return
+        if ctx.finished_at is None:
+            # エラーの埋め込みだけ返した
+            result.errors += 1
+            return
+        result.latencies.append(ctx.finished_at - ctx.created)
+
+    async with Measure(result):
+        await asyncio.gather(*(run() for _ in range(concurrency)))
+    return result
+
+
+async def txt2img_cached(env: Env, concurrency: int = 50) -> Result:
+    """seedを固定した同じ/sd txt2imgを、1回生成したあとに別々のユーザーが実行する"""
+    kwargs = {"prompt": "1girl, cached", "seed": 42}
+    await env.txt2img.callback(env.sd_group, env.interaction(), **kwargs)
+    generated = env.stub.generated
+    result = Result()
+
+    async def run():
+        ctx = env.interaction()
+        try:
+            await env.txt2img.callback(env.sd_group, ctx, **kwargs)
+        except Exception:
+            result.errors += 1
+            return
+        if ctx.finished_at is None:
+            result.errors += 1
+            return
+        result.latencies.append(ctx.finished_at - ctx.created)
+
+    async with Measure(result):
+        await asyncio.gather(*(run() for _ in range(concurrency)))
+    # キャッシュから返せていればwebuiでは生成していない
+    result.errors += env.stub.generated - generated
+    return result
+
+
+async def autocomplete(env: Env, calls: int = 20000, concurrency: int = 100) -> Result:
+    """モデルとサンプラーのオートコンプリートが連打される"""
+    completions = env.generate_image.AutoCompletions
+    words = ["", "m", "mo", "model-1", "anime", "real", "0", "42", "dpm", "karras", "eul"]
+    result = Result()
+    remaining = calls
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            ctx = env.interaction()
+            text = random.choice(words)
+            handler = completions.model if remaining % 2 else completions.sampler
+            s = time.perf_counter()
+            try:
+                await handler(ctx, text)
+            except Exception:
+                result.errors += 1
+                continue
+            result.latencies.append(time.perf_counter() - s)
+            # 実際は1回ごとにgatewayから届くので、他のタスクに譲る
+            await asyncio.sleep(0)
+
+    async with Measure(result):
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return result
+
+
+async def rta_list(env: Env, rtas: int = 2000, concurrency: int = 200) -> Result:
+    """RTAが多いサーバーで/get_rtaを開いて次のページへ進む"""
+    now = dt.datetime.now(dt.timezone.utc)
+    ids = [
+        await env.db.add_rta(now + dt.timedelta(days=1, minutes=i), env.interaction())
+        for i in range(rtas)
+    ]
+    result = Result()
+
+    async def run():
+        user = FakeUser()
+        ctx = env.interaction(user)
+        try:
+            await env.rta.get_rta.callback(env.rta, ctx, "ASC")
+            view = ctx.messages[0]["view"]
+            await view.next_page.callback(env.interaction(user))
+        except Exception:
+            result.errors += 1
+            return
+        result.latencies.append(time.perf_counter() - ctx.created)
+
+    async with Measure(result):
+        await asyncio.gather(*(run() for _ in range(concurrency)))
+    for i in ids:
+        await env.db.delete_rta(i)
+    return result
+
+
+SCENARIOS = {
+    "rta_messages": rta_messages,
+    "txt2img": txt2img,
+    "txt2img_cached": txt2img_cached,
+    "autocomplete": autocomplete,
+    "rta_list": rta_list,
+}
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    lines = []
+    for name, result in new["scenarios"].items():
+        before = old.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p99_ms", "throughput_per_s", "loop_lag_p99_ms"):
+            a, b = before[key], result[key]
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            lines.append(f"{name}.{key}: {a} -> {b} ({change})")
+    return lines
+
+
+async def main(args: argparse.Namespace):
+    env = Env()
+    await env.start()
+    results = {}
+    try:
+        for name in args.scenario or SCENARIOS:
+            results[name] = (await SCENARIOS[name](env)).summary()
+    finally:
+        await env.close()
+    return {
+        "python": sys.version.split()[0],
+        "time": dt.datetime.now().isoformat(timespec="seconds"),
+        "scenarios": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    parser.add_argument("--out", type=Path, help="結果を保存するJSONファイル")
+    parser.add_argument("--compare", type=Path, help="比べる前の結果のJSONファイル")
+    args = parser.parse_args()
+    # 一時ディレクトリに移る前に絶対パスにしておく
+    out = args.out.resolve() if args.out else None
+    old = json.loads(args.compare.resolve().read_text()) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as d:
+        # dbディレクトリを一時ディレクトリに作らせる
+        os.chdir(d)
+        report = asyncio.run(main(args))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if out is not None:
+        out.write_text(text + "\n")
+    if old is not None:
+        print("\n".join(compare(old, report)), file=sys.stderr)
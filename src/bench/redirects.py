@@ -0,0 +1,78 @@
+"""/extract_urlのリダイレクト解決のベンチマーク
+
+ローカルのリダイレクトサーバーに対して、毎回セッションを作る以前の方法、
+共有クライアント、キャッシュありの共有クライアントを比べる。
+srcディレクトリで ``python -m bench.redirects`` のように実行する。
+"""
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from utils.http import HTTPClient
+
+HOPS = 3
+REQUESTS = 200
+CONCURRENCY = 20
+LINKS = 10
+
+
+async def redirect(request: web.Request):
+    n = int(request.match_info["n"])
+    if n == 0:
+        return web.Response(text="ok")
+    raise web.HTTPFound(f"/r/{n - 1}")
+
+
+async def start_server() -> tuple[web.AppRunner, int]:
+    app = web.Application()
+    app.router.add_route("*", "/r/{n}", redirect)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]  # type: ignore
+
+
+async def old_way(url: str):
+    # 以前のextract_urlと同じ方法
+    async with aiohttp.ClientSession() as session:
+        async with session.head(url, allow_redirects=True) as resp:
+            return list(map(lambda x: x.url, resp.history)) + [resp.url]
+
+
+async def bench(name: str, resolve, urls: list[str]):
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(url):
+        async with sem:
+            await resolve(url)
+
+    s = time.perf_counter()
+    await asyncio.gather(*(one(urls[i % len(urls)]) for i in range(REQUESTS)))
+    elapsed = time.perf_counter() - s
+    print(f"{name:>14}: {REQUESTS / elapsed:8.1f} req/s")
+
+
+async def main():
+    runner, port = await start_server()
+    # ローカルのサーバーなので検証は外す
+    urls = [f"http://127.0.0.1:{port}/r/{HOPS}?link={i}" for i in range(LINKS)]
+
+    await bench("new session", old_way, urls)
+
+    client = HTTPClient()
+    client.redirects.maxsize = 0
+    await bench("shared", lambda u: client.resolve_redirects(u, validate=lambda _: True), urls)
+    await client.close()
+
+    client = HTTPClient()
+    await bench("shared+cache", lambda u: client.resolve_redirects(u, validate=lambda _: True), urls)
+    print(f"cache hits={client.redirects.hits} misses={client.redirects.misses}")
+    await client.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""繰り返しのRTAが10万件あるときのスケジューラのベンチマーク
+
+スケジュールの読み込み、期限が来たイベントの取り出し、次の回の展開にかかる時間を測る。
+srcディレクトリで ``python -m bench.rta_schedules`` のように実行する。
+"""
+import asyncio
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import db
+from utils.rta_scheduler import RTAScheduler
+
+SCHEDULES = 100_000
+DUE = 1_000
+
+
+async def noop(event, row):
+    pass
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as d:
+        bot_db = db.BotDB(sqlite3.connect(Path(d, "bench.sqlite")))
+        now = time.time()
+        rows = [
+            (
+                i, i % 100, i % 5000, 0,
+                now + 120 + random.uniform(0, 86400), float(random.randint(2, 1440) * 60), 100,
+            )
+            for i in range(SCHEDULES)
+        ]
+        with bot_db.db:
+            bot_db.db.executemany("INSERT INTO rta_schedule VALUES (?,?,?,?,?,?,?);", rows)
+
+        scheduler = RTAScheduler(noop)
+        s = time.perf_counter()
+        schedules = bot_db.get_all_rta_schedule()
+        for i in schedules:
+            scheduler.add_schedule(i)
+        print(f"load {SCHEDULES} schedules: {(time.perf_counter() - s) * 1000:.1f}ms")
+
+        # 早い順にDUE件が期限を迎えた時刻で取り出す
+        deadline = sorted(i["start_date"] for i in schedules)[DUE - 1]
+        s = time.perf_counter()
+        due = scheduler._pop_due(deadline - scheduler.margin - scheduler.lead)
+        pop = time.perf_counter() - s
+        print(f"pop {len(due)} due events: {pop / len(due) * 1e6:.1f}us/event")
+
+        s = time.perf_counter()
+        for entry in due:
+            rta, schedule = bot_db.expand_rta_schedule(entry.row["id"], now)
+            if rta is not None:
+                scheduler.add(rta)
+            if schedule is not None:
+                scheduler.add_schedule(schedule)
+        expand = time.perf_counter() - s
+        print(f"expand {len(due)} occurrences: {expand / len(due) * 1e6:.1f}us/event")
+        bot_db.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
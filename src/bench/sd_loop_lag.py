@@ -0,0 +1,69 @@
+"""生成中もイベントループが止まらないこと(/pingの遅延が増えないこと)を確認する
+
+遅延のp99がMAX_LAG_P99を超えたら終了コード1で終わる。
+srcディレクトリで ``python -m bench.sd_loop_lag`` のように実行する。
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from bench.stub_webui import StubWebUI
+from utils import stable_diffusion as sd
+from utils.image_output import ImageFormat, ImagePipeline
+
+CONCURRENT = 8
+TICK = 0.01
+# 画像の変換などでループを止めていれば数百msになる
+MAX_LAG_P99 = 0.05
+
+
+async def measure_lag(stop: asyncio.Event, lags: list[float]):
+    while not stop.is_set():
+        s = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - s - TICK)
+
+
+async def generate(models: sd.ModelsAPI, pipeline: ImagePipeline, option: sd.Options):
+    await models.set_current_options(option)
+    img = await models.txt2img(prompt="1girl", steps=20)
+    await pipeline.prepare(img.images[0], ImageFormat.PNG)
+
+
+async def main() -> bool:
+    stub = StubWebUI(generate_delay=0.5, switch_delay=1.0)
+    port = await stub.start()
+    models = sd.ModelsAPI(port=port)
+    pipeline = ImagePipeline()
+    options = [sd.Options(model=m, vae=stub.vaes[0]) for m in stub.models]
+
+    stop = asyncio.Event()
+    lags: list[float] = []
+    ticker = asyncio.create_task(measure_lag(stop, lags))
+    s = time.perf_counter()
+    await asyncio.gather(
+        *(generate(models, pipeline, options[i % len(options)]) for i in range(CONCURRENT))
+    )
+    elapsed = time.perf_counter() - s
+    stop.set()
+    await ticker
+    await models.close()
+    pipeline.close()
+    await stub.stop()
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)]
+    print(
+        f"{CONCURRENT} generations in {elapsed:.2f}s, "
+        f"loop lag p50={statistics.median(lags) * 1000:.2f}ms "
+        f"p99={p99 * 1000:.2f}ms max={lags[-1] * 1000:.2f}ms"
+    )
+    if p99 > MAX_LAG_P99:
+        print(f"NG: 遅延のp99が{MAX_LAG_P99 * 1000:.0f}msを超えました", file=sys.stderr)
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
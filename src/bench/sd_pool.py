@@ -0,0 +1,66 @@
+"""複数のwebuiに振り分けたときのスループットと、1台落ちたときのフェイルオーバーを測る
+
+スタブのwebuiを何台か立て、モデルの違うジョブをまとめて投げる。
+途中で1台止めても全部のジョブが終わることを確認し、失敗したジョブがあれば終了コード1で終わる。
+srcディレクトリで ``python -m bench.sd_pool`` のように実行する。
+"""
+import asyncio
+import sys
+import time
+
+from bench.stub_webui import StubWebUI
+from utils import stable_diffusion as sd
+from utils.sd_pool import BackendPool
+
+JOBS = 24
+USERS = 8
+
+
+async def run(backends: int, kill: bool = False) -> tuple[str, int]:
+    stubs = [StubWebUI(generate_delay=0.2, switch_delay=1.0) for _ in range(backends)]
+    ports = [await i.start() for i in stubs]
+    pool = BackendPool([sd.ModelsAPI(port=i) for i in ports], max_per_user=JOBS)
+    pool.start()
+    while not all(i.backend.ready for i in pool.members):
+        await asyncio.sleep(0.05)
+
+    models = stubs[0].models[:2]
+    options = [sd.Options(model=m, vae=stubs[0].vaes[0]) for m in models]
+    s = time.perf_counter()
+    jobs = [
+        pool.submit(i % USERS, options[i % len(options)], {"prompt": "1girl"})
+        for i in range(JOBS)
+    ]
+    if kill:
+        await asyncio.sleep(0.5)
+        await stubs[0].stop()
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    elapsed = time.perf_counter() - s
+
+    failed = sum(1 for i in results if isinstance(i, BaseException))
+    switches = sum(i.switches for i in stubs)
+    generated = [i.generated for i in stubs]
+    breakers = [i.breaker.state.value for i in pool.members]
+    await pool.close()
+    for i in stubs:
+        await i.stop()
+    line = (
+        f"{backends} backend(s){' (1 killed)' if kill else ''}: {JOBS} jobs in {elapsed:.2f}s, "
+        f"failed={failed} switches={switches} per-backend={generated} breakers={breakers}"
+    )
+    return line, failed
+
+
+async def main() -> bool:
+    ok = True
+    for backends, kill in ((1, False), (3, False), (3, True)):
+        line, failed = await run(backends, kill)
+        print(line)
+        if failed:
+            print(f"NG: {failed}件のジョブが失敗しました", file=sys.stderr)
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
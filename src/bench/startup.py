@@ -0,0 +1,55 @@
+"""webuiが落ちているときの起動時間を測る
+
+setup_hookでやっていること(バックエンドの開始と拡張の読み込み)にかかる時間を測る。
+ここが終わればgatewayに接続しに行ける。
+srcディレクトリで ``python -m bench.startup`` のように実行する。
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import discord
+from discord.ext import commands
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main():
+    from utils import sd_pool
+    from utils import stable_diffusion as sd
+
+    # 誰も待ち受けていないポートにつなぐ
+    sd_pool.pool = sd_pool.BackendPool([sd.ModelsAPI(port=unused_port())])
+    bot = commands.Bot(command_prefix="!", intents=discord.Intents.default())
+
+    s = time.perf_counter()
+    sd_pool.pool.start()
+    await bot.load_extension("cogs.common")
+    await bot.load_extension("cogs.generate_image")
+    elapsed = time.perf_counter() - s
+    print(f"setup_hook: {elapsed * 1000:.1f}ms (webui: {sd_pool.pool.state.value})")
+
+    await asyncio.sleep(0.5)
+    print(f"after 0.5s webui: {sd_pool.pool.state.value}")
+    await bot.unload_extension("cogs.generate_image")
+    await bot.unload_extension("cogs.common")
+    await sd_pool.pool.close()
+    from utils import http
+    await http.client.close()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as d:
+        # dbディレクトリを一時ディレクトリに作らせる
+        os.chdir(d)
+        asyncio.run(main())
@@ -0,0 +1,152 @@
+"""ベンチマーク用のstable-diffusion-webuiのスタブ
+
+本物と同じパスでAPIを返すが、生成は指定した時間待つだけ。
+"""
+import asyncio
+import base64
+import json
+import time
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+
+def _png(size: int = 64) -> str:
+    img = Image.new("RGB", (size, size), (200, 120, 40))
+    buf = BytesIO()
+    img.save(buf, format="png")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+class StubWebUI:
+    """スタブのwebuiサーバー
+
+    Args:
+        generate_delay (float): txt2img1枚あたりにかかる秒数
+        switch_delay (float): モデルを切り替えるのにかかる秒数
+        models (list[str]): モデルの一覧
+        vaes (list[str]): VAEの一覧
+    """
+    def __init__(
+        self,
+        generate_delay: float = 1.0,
+        switch_delay: float = 2.0,
+        models: list[str] | None = None,
+        vaes: list[str] | None = None,
+    ) -> None:
+        self.generate_delay = generate_delay
+        self.switch_delay = switch_delay
+        self.models = models or ["HimawariMix-v8", "anything-v5", "nsfw-model"]
+        self.vaes = vaes or ["clearvae_v23.safetensors", "vae-ft-mse.safetensors"]
+        self.options = {"sd_model_checkpoint": self.models[0], "sd_vae": self.vaes[0]}
+        self.switches = 0
+        self.generated = 0
+        self.image = _png()
+        self.port = 0
+        self.progress_requests = 0
+        # 生成中のジョブの(開始時刻, かかる秒数)
+        self._running: tuple[float, float] | None = None
+        self._runner: web.AppRunner | None = None
+        # 本物と同じく生成は1つずつしか進まない
+        self._gpu = asyncio.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_get("/sdapi/v1/options", self.get_options)
+        app.router.add_post("/sdapi/v1/options", self.set_options)
+        app.router.add_get("/sdapi/v1/sd-models", self.sd_models)
+        app.router.add_get("/sdapi/v1/sd-vae", self.sd_vae)
+        app.router.add_get("/sdapi/v1/embeddings", self.embeddings)
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_get("/sdapi/v1/progress", self.progress)
+        return app
+
+    async def start(self, port: int = 0) -> int:
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        return self.port
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def get_options(self, request: web.Request):
+        return web.json_response(self.options)
+
+    async def set_options(self, request: web.Request):
+        body = await request.json()
+        async with self._gpu:
+            model = body.get("sd_model_checkpoint")
+            if model is not None and model != self.options["sd_model_checkpoint"]:
+                self.switches += 1
+                await asyncio.sleep(self.switch_delay)
+            self.options.update(body)
+        return web.json_response(None)
+
+    async def sd_models(self, request: web.Request):
+        return web.json_response([{"model_name": i, "title": i} for i in self.models])
+
+    async def sd_vae(self, request: web.Request):
+        return web.json_response([{"model_name": i, "filename": i} for i in self.vaes])
+
+    async def embeddings(self, request: web.Request):
+        return web.json_response({"loaded": {"EasyNegative": {}}, "skipped": {}})
+
+    async def progress(self, request: web.Request):
+        self.progress_requests += 1
+        if self._running is None:
+            return web.json_response(
+                {"progress": 0.0, "eta_relative": 0.0, "state": {"job_count": 0},
+                 "current_image": None}
+            )
+        start, duration = self._running
+        elapsed = time.monotonic() - start
+        skip = request.query.get("skip_current_image", "false") == "true"
+        return web.json_response({
+            "progress": min(elapsed / duration, 1.0),
+            "eta_relative": max(duration - elapsed, 0.0),
+            "state": {"job_count": 1},
+            "current_image": None if skip else self.image,
+        })
+
+    async def txt2img(self, request: web.Request):
+        body = await request.json()
+        batch_size = body.get("batch_size", 1)
+        n_iter = body.get("n_iter", 1)
+        async with self._gpu:
+            # バッチ内は並列に進むので、かかる時間は繰り返しの回数に比例させる
+            duration = self.generate_delay * n_iter
+            self._running = (time.monotonic(), duration)
+            await asyncio.sleep(duration)
+            self._running = None
+            self.generated += batch_size * n_iter
+        seed = body.get("seed", -1)
+        seed = seed if seed != -1 else 1234
+        seeds = [seed + i for i in range(batch_size * n_iter)]
+        info = {
+            "seed": seed,
+            "all_seeds": seeds,
+            "sd_model_name": self.options["sd_model_checkpoint"],
+        }
+        return web.json_response(
+            {"images": [self.image] * len(seeds), "parameters": body, "info": json.dumps(info)}
+        )
+
+
+async def main():
+    stub = StubWebUI()
+    print("listening on", await stub.start(7861))
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,19 +2,25 @@ import datetime as dt
 import logging
 import math
 import re
+import sqlite3
 from random import randint
 
-import aiohttp
 import coloredlogs
 import discord
-import yarl
 from discord import app_commands as ac
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.ext.commands import Bot
 
 import db
-
-main_db = db.BotDB.get_default_db()
+from utils import http
+from utils.announcer import Announcer
+from utils.cluster import RTACluster
+from utils.school_schedule import ScheduleCache, ScheduleError
+from utils.rta_registry import ActiveRTARegistry
+from utils.rta_scheduler import RTAEventType, RTAScheduler
+
+main_db = db.get_shared_db()
+schedule_cache = ScheduleCache(main_db)
 coloredlogs.install()
 logger = logging.getLogger(__name__)
 
@@ -28,6 +34,13 @@ class CommonCommands(commands.Cog):
     def __init__(self, bot: Bot):
         self.bot = bot
 
+    async def cog_load(self):
+        await schedule_cache.load()
+        schedule_cache.start()
+
+    async def cog_unload(self):
+        schedule_cache.stop()
+
     @ac.command(name="ping", description="Ping!!!")
     async def ping(self, ctx: discord.Interaction):
         sec = round(self.bot.latency * 1000)
@@ -50,34 +63,23 @@ class CommonCommands(commands.Cog):
         if not re.match(r".*://", url):
             url = "https://" + url
 
-        async def validate(url):
-            IP_REGEX = r"^((25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])$"  # NOQA
-            try:
-                parsed = yarl.URL(url)
-            except ValueError:
-                return False
-            return (
-                parsed.host is not None
-                and parsed.scheme in ("http", "https")
-                and parsed.host != "localhost"
-                and not re.match(IP_REGEX, parsed.host)
-            )
-
-        if not await validate(url):
+        if not http.is_safe_url(url):
             embed = discord.Embed(title="失敗", description="無効なURLかIPアドレスで指定されています")
             await ctx.response.send_message(embed=embed)
             return
 
-        header = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"}  # NOQA
         try:
-            async with aiohttp.ClientSession(headers=header) as session:
-                async with session.head(url, allow_redirects=True) as resp:
-                    history = list(map(lambda x: x.url, resp.history)) + [resp.url]
-                    status = resp.status
+            result = await http.client.resolve_redirects(url)
+        except http.UnsafeURLError:
+            embed = discord.Embed(title="失敗", description="リダイレクト先が無効なURLかIPアドレスです")
+            await ctx.response.send_message(embed=embed)
+            return
         except Exception:
             embed = discord.Embed(title="エラー！", description="リクエストに失敗した")
             await ctx.response.send_message(embed=embed)
             return
+        history = result.history
+        status = result.status
 
         if len(history) == 1:
             embed = discord.Embed(title="結果", description="リダイレクトは無かった")
@@ -89,29 +91,46 @@ class CommonCommands(commands.Cog):
 
     @ac.command(name="school_schedule", description="つくったひと(@ujex256)の学校のスケジュール")
     async def school_schedule(self, ctx: discord.Interaction, day: int | None = None):
-        await ctx.response.send_message(embed=discord.Embed(title="取得中..."))
-        async with aiohttp.ClientSession() as req:
-            day = day if day else dt.datetime.today().day
-            url = "https://school_schedule-1-u5735815.deta.app/?day=" + str(day)
-            async with req.get(url) as resp:
-                if resp.status == 500:
-                    err = discord.Embed(
-                        title="エラー！", description="不明なエラー",
-                        color=discord.Color.red()
-                    )
-                    await ctx.response.edit_message(embed=err)
-                    return
-                elif resp.status == 404:
-                    err = discord.Embed(
-                        title="エラー！", description="その日は学校がない",
-                        color=discord.Color.red()
-                    )
-                    await ctx.response.edit_message(embed=err)
-                    return
-                json = await resp.json()
+        today = dt.date.today()
+        try:
+            date = today.replace(day=day) if day else today
+        except ValueError:
+            err = discord.Embed(
+                title="エラー！", description="その日はない",
+                color=discord.Color.red()
+            )
+            await ctx.response.send_message(embed=err)
+            return
+        # キャッシュがあればすぐ返す。古ければ裏で取り直される
+        entry = schedule_cache.get_cached(date)
+        if entry is None:
+            await ctx.response.send_message(embed=discord.Embed(title="取得中..."))
+            try:
+                entry = await schedule_cache.refresh(date)
+            except ScheduleError:
+                err = discord.Embed(
+                    title="エラー！", description="不明なエラー",
+                    color=discord.Color.red()
+                )
+                await ctx.edit_original_response(embed=err)
+                return
+
+        if entry.data is None:
+            embed = discord.Embed(
+                title="エラー！", description="その日は学校がない",
+                color=discord.Color.red()
+            )
+        else:
+            embed = self._schedule_embed(entry.data)
+        if ctx.response.is_done():
+            await ctx.edit_original_response(embed=embed)
+        else:
+            await ctx.response.send_message(embed=embed)
 
+    @staticmethod
+    def _schedule_embed(json: dict) -> discord.Embed:
         back_home_time = json["end_afternoon_homeroom"].split(":")
-        if back_home_time[0] < 15:
+        if int(back_home_time[0]) < 15:
             title = "@ujex256は早く帰れるらしい"
         elif "短縮" in json["schedule_type"]:
             title = "短縮時程らしい"
@@ -126,11 +145,11 @@ class CommonCommands(commands.Cog):
             "club_exists": "部活があるか",
             "end_afternoon_homeroom": "終会終了時間",
         }
-        for i, j in json.values():
+        for i, j in json.items():
             if i not in key_map.keys():
                 continue
             embed.description += f"{key_map[i]}: {str(j)}\n"  # type: ignore
-        await ctx.response.edit_message(embed=embed)
+        return embed
 
     @school_schedule.error
     async def sc_error(self, ctx: discord.Interaction, error):
@@ -140,12 +159,18 @@ class CommonCommands(commands.Cog):
             color=discord.Colour.red()
         )
         print("err")
-        await ctx.edit_original_response(embed=embed)
+        if ctx.response.is_done():
+            await ctx.edit_original_response(embed=embed)
+        else:
+            await ctx.response.send_message(embed=embed)
 
 
 class RTACog(commands.Cog):
     """RTA関係のCog
-    5秒ごとに確認を行います
+    開始/終了の時刻になったらスケジューラから通知されます
+
+    複数のプロセスで動かすときは、リーダーのプロセスだけがスケジューラを動かし、
+    開始/終了はサーバーを受け持つプロセスに渡して処理します
 
     Args:
         bot (bot): _description_
@@ -154,91 +179,145 @@ class RTACog(commands.Cog):
 
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
-        self.receiving = []
-        self.receiving_ch = []
-
-        now = dt.datetime.utcnow().time()
-        tg_sec = (now.second - now.second % 5) + 5
-        start = now.replace(
-            second=tg_sec if tg_sec < 60 else 0,
-            microsecond=0,
+        self.active = ActiveRTARegistry()
+        self.scheduler = RTAScheduler(self.check_rta)
+        self.ranking = db.RankingBuffer(main_db)
+        self.announcer = Announcer(self._text_channel)
+        self.cluster = RTACluster(
+            main_db,
+            getattr(bot, "shard_ids", None),
+            bot.shard_count,
+            self.on_leader,
+            self.on_cluster_event,
         )
-        self.task_starter.change_interval(time=start)
-        self.task_starter.count = 1
-        self.task_starter.start()
+
+    async def cog_load(self):
+        self.ranking.start()
+        self.cluster.start()
+
+    async def on_leader(self, leader: bool):
+        if not leader:
+            self.scheduler.stop()
+            self.scheduler = RTAScheduler(self.check_rta)
+            return
+        for i in await main_db.get_all_rta():
+            self.scheduler.add(i)
+        schedules = await main_db.get_all_rta_schedule()
+        for i in schedules:
+            self.scheduler.add_schedule(i)
+        self.scheduler.start()
+        logger.info(
+            f"{len(self.scheduler)}件のRTAと{len(schedules)}件の繰り返しのRTAを読み込みました。"
+        )
+
+    async def on_cluster_event(self, event: str, rta_id: int):
+        # リーダー宛て
+        if event == "add_schedule":
+            schedule = await main_db.get_rta_schedule(rta_id)
+            if schedule is not None:
+                self.scheduler.add_schedule(schedule)
+            return
+        rows = await main_db.get_rta(rta_id)
+        if not rows:
+            return
+        if event == "add_rta":
+            if rta_id not in self.scheduler:
+                self.scheduler.add(rows[0])
+            return
+        # このプロセスが受け持つサーバーの開始/終了
+        await self.handle_rta(RTAEventType(event), rows[0])
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        ch_id = message.channel.id
-        if ch_id not in self.receiving_ch or message.author.bot:
+        if message.author.bot:
+            return
+        rtas = self.active.get(message.channel.id)
+        if not rtas:
             return
-        rta = main_db.get_rta(self.receiving[self.receiving_ch.index(ch_id)])[0]
-        rta_date = dt.datetime.fromtimestamp(rta["date"], tz=dt.UTC)
-        diff = rta_date - message.created_at
-        time_diff = round(diff.total_seconds(), 3)
 
-        embed = discord.Embed(
-            title="結果", description=f"{time_diff}秒の差"
-        )
+        created = message.created_at.timestamp()
         uid = message.author.id
-        high_sc = main_db.get_high_score(rta["id"], user_id=uid, absolute=True)
-
-        if high_sc is None or high_sc > abs(time_diff):
-            main_db.append_ranking(rta["id"], uid, time_diff)
-            embed.title = "記録更新"
-        await message.reply(embed=embed)
-
-    def cog_unload(self):
-        self.check_rta.cancel()
-
-    @tasks.loop()
-    async def task_starter(self):
-        print("今の時間は", dt.datetime.now(tz=self.jst))
-        self.check_rta.start()
-        self.task_starter.stop()
-
-    @tasks.loop(seconds=5)
-    async def check_rta(self):
-        for i in main_db.get_all_rta_iter():
-            time = dt.datetime.fromtimestamp(i["date"], tz=self.jst)
-            dur = time - dt.datetime.now(tz=dt.UTC)
-            time_diff = math.floor(dur.total_seconds())
-            if time_diff > 15:
-                continue
+        embeds = []
+        updated = False
+        for rta in rtas:
+            time_diff = round(rta.timestamp - created, 3)
+            embed = discord.Embed(
+                title="結果", description=f"{time_diff}秒の差"
+            )
+            if rta.submit(uid, time_diff):
+                self.ranking.submit(rta.id, uid, time_diff)
+                updated = True
+                embed.title = "記録更新"
+            embeds.append(embed)
+
+        if updated:
+            # 書き込みが終わってから返信する
+            await self.ranking.wait_flushed()
+        await message.reply(embeds=embeds[:10])
+
+    async def cog_unload(self):
+        self.scheduler.stop()
+        await self.cluster.stop()
+        await self.ranking.close()
+        await self.announcer.close()
+
+    def _text_channel(self, channel_id: int) -> discord.TextChannel | None:
+        ch = self.bot.get_channel(channel_id)
+        return ch if isinstance(ch, discord.TextChannel) else None
+
+    async def check_rta(self, event: RTAEventType, i: sqlite3.Row):
+        # 繰り返しのRTAの次の回を追加する時
+        if event is RTAEventType.EXPAND:
+            now = dt.datetime.now().timestamp()
+            rta, schedule = await main_db.expand_rta_schedule(i["id"], now)
+            if rta is not None:
+                self.scheduler.add(rta)
+                logger.info(f"繰り返しのRTA(id: {i['id']})からRTA(id: {rta['id']})を追加しました。")
+            if schedule is not None:
+                self.scheduler.add_schedule(schedule)
+            return
 
-            ch = self.bot.get_channel(i["channel_id"])
-            if not isinstance(ch, discord.TextChannel):
-                raise Exception
-
-            # 終了後の時
-            if time_diff <= -15:
-                embed = discord.Embed(title="終わった *!!!*")
-                try:
-                    self.receiving.remove(i["id"])
-                    self.receiving_ch.remove(i["channel_id"])
-                except ValueError:
-                    pass
-                main_db.delete_rta(i["id"])
-                embed2 = discord.Embed(title="ランキング", color=discord.Color.blue())
-                for j, k in enumerate(main_db.get_ranking(i["id"])):
-                    embed2.add_field(
-                        name=f"{j+1}位 <@{k['user_id']}>",
-                        value=f"{k['diff']}秒"
-                    )
-                logger.info(f"RTA(id: {i['id']})を終了しました。")
-                await ch.send(embeds=[embed, embed2])
-                return
+        if await self.cluster.forward(event.value, i["guild_id"], i["id"]):
+            return
+        await self.handle_rta(event, i)
+
+    async def handle_rta(self, event: RTAEventType, i: sqlite3.Row):
+        """開始/終了を処理する。お知らせはannouncerが裏で送るので、送り終わるのを待たない"""
+        # 終了後の時
+        if event is RTAEventType.END:
+            embed = discord.Embed(title="終わった *!!!*")
+            rta = self.active.remove(i["id"])
+            await self.ranking.flush()
+            if rta is not None:
+                results = list(rta.board)
+            else:
+                # 開始を見ていないときはDBから順位を作る
+                results = [(k["user_id"], k["diff"]) for k in await main_db.get_ranking(i["id"])]
+            await main_db.finish_rta(i["id"], results)
+            embed2 = discord.Embed(title="ランキング", color=discord.Color.blue())
+            # 埋め込みのフィールドは25個まで
+            for j, (user_id, diff) in enumerate(results[:25]):
+                embed2.add_field(
+                    name=f"{j+1}位 <@{user_id}>",
+                    value=f"{diff}秒"
+                )
+            logger.info(f"RTA(id: {i['id']})を終了しました。")
+            self.announcer.send(i["channel_id"], embeds=[embed, embed2])
+            return
 
-            # 30秒前の時
-            if i["id"] in self.receiving:
-                continue
-            embed = discord.Embed(
-                title="RTA開始",
-                description=f"設定された時刻は<t:{int(i['date'])}>です")
-            self.receiving.append(i["id"])
-            self.receiving_ch.append(i["channel_id"])
-            logger.info(f"RTA(id: {i['id']})を開始しました。")
-            await ch.send(embed=embed)
+        # 15秒前の時
+        if i["id"] in self.active:
+            return
+        self.active.add(i, await main_db.get_ranking(i["id"]))
+        # 他のプロセスや再起動前に開始を知らせていれば、受付だけ始める
+        if not await main_db.start_rta(i["id"]):
+            logger.info(f"RTA(id: {i['id']})は開始済みなので受付だけ再開しました。")
+            return
+        embed = discord.Embed(
+            title="RTA開始",
+            description=f"設定された時刻は<t:{int(i['date'])}>です")
+        logger.info(f"RTA(id: {i['id']})を開始しました。")
+        self.announcer.send(i["channel_id"], embed=embed)
 
     @ac.command(name="add_rta", description="RTAのスケジュールを追加します")
     @ac.guild_only()
@@ -262,13 +341,21 @@ class RTACog(commands.Cog):
                 title="エラー！", description="もっと遅い時間にして",
                 color=discord.Color.red()
             )
-        elif main_db.get_near_rta(int(date.timestamp()), ctx.channel_id):  # type: ignore
+        elif await main_db.get_near_rta(int(date.timestamp()), ctx.channel_id):  # type: ignore
             embed = discord.Embed(
                 title="エラー!", description="時間が被っています",
                 color=discord.Color.red()
             )
+        elif await main_db.get_near_rta_schedule(int(date.timestamp()), ctx.channel_id):  # type: ignore
+            # 繰り返しのRTAの回はまだrta_dbにないので別に確認する
+            embed = discord.Embed(
+                title="エラー!", description="繰り返しのRTAと時間が被っています",
+                color=discord.Color.red()
+            )
         else:
-            main_db.add_rta(date, ctx)
+            rta_id = await main_db.add_rta(date, ctx)
+            if not await self.cluster.to_leader("add_rta", rta_id):
+                self.scheduler.add((await main_db.get_rta(rta_id))[0])
             embed = discord.Embed(
                 title="設定しました",
                 description=f"<t:{int(date.timestamp())}:f>に設定しました",
@@ -277,6 +364,187 @@ class RTACog(commands.Cog):
         logger.info(f"RTAを追加しました(日本時間: {date.strftime('%Y/%m/%d %H:%M:%S')})")
         await ctx.response.send_message(embed=embed)
 
+    @ac.command(name="add_rta_schedule", description="繰り返しのRTAを追加します")
+    @ac.describe(interval="間隔(分)", count="回数")
+    @ac.guild_only()
+    async def add_rta_schedule(
+        self,
+        ctx: discord.Interaction,
+        month: int,
+        day: int,
+        hour: int,
+        minute: int,
+        interval: ac.Range[int, 2, 60 * 24 * 365],
+        count: ac.Range[int, 1, 10000],
+        year: int | None = None,
+        second: int = 0,
+    ):
+        if year is None:
+            year = dt.datetime.today().year
+
+        date = dt.datetime(year, month, day, hour, minute, second, tzinfo=self.jst)
+        diff = date - dt.datetime.now(tz=dt.UTC)
+        interval_sec = interval * 60
+        # 最初の何回かが既にあるRTAと被っていないか確認する
+        first = int(date.timestamp())
+        near = [
+            await main_db.get_near_rta(first + interval_sec * i, ctx.channel_id)  # type: ignore
+            or await main_db.get_near_rta_schedule(first + interval_sec * i, ctx.channel_id)  # type: ignore
+            for i in range(min(count, 10))
+        ]
+        if diff.total_seconds() < 20:
+            embed = discord.Embed(
+                title="エラー！", description="もっと遅い時間にして",
+                color=discord.Color.red()
+            )
+        elif any(near):
+            embed = discord.Embed(
+                title="エラー!", description="時間が被っています",
+                color=discord.Color.red()
+            )
+        else:
+            schedule_id = await main_db.add_rta_schedule(date, interval_sec, count, ctx)
+            if not await self.cluster.to_leader("add_schedule", schedule_id):
+                self.scheduler.add_schedule(await main_db.get_rta_schedule(schedule_id))
+            embed = discord.Embed(
+                title="設定しました",
+                description=f"<t:{first}:f>から{interval}分ごとに{count}回",
+                color=discord.Color.blue()
+            )
+            logger.info(f"繰り返しのRTAを追加しました(日本時間: {date.strftime('%Y/%m/%d %H:%M:%S')})")
+        await ctx.response.send_message(embed=embed)
+
+    @ac.command(name="list_rta_schedule", description="繰り返しのRTAを表示")
+    @ac.guild_only()
+    async def list_rta_schedule(self, ctx: discord.Interaction):
+        if ctx.guild_id is None:
+            raise
+        schedules = await main_db.get_guild_rta_schedule(ctx.guild_id)
+        total = await main_db.count_guild_rta_schedule(ctx.guild_id)
+        resp = discord.Embed(title="このサーバーの繰り返しのRTA", colour=discord.Color.blurple())
+        for i, j in enumerate(schedules):
+            resp.add_field(
+                name=f"{i+1}. <#{j['channel']}>",
+                value=(
+                    f"次: <t:{int(j['start_date'])}:f>\n"
+                    f"{int(j['interval_sec'] // 60)}分ごと、残り{j['remaining_count']}回"
+                ),
+            )
+        resp.set_footer(text=f"全{total}件")
+        await ctx.response.send_message(embed=resp)
+
+    @ac.command(name="delete_rta_schedule", description="繰り返しのRTAを削除します")
+    @ac.describe(number="/list_rta_schedule の番号")
+    @ac.guild_only()
+    async def delete_rta_schedule(self, ctx: discord.Interaction, number: int):
+        if ctx.guild_id is None:
+            raise
+        schedules = await main_db.get_guild_rta_schedule(ctx.guild_id)
+        if not 1 <= number <= len(schedules):
+            embed = discord.Embed(
+                title="エラー！", description="その番号の繰り返しのRTAはありません",
+                color=discord.Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+        schedule = schedules[number - 1]
+        permissions = getattr(ctx.user, "guild_permissions", None)
+        if schedule["created_user"] != ctx.user.id and not (permissions and permissions.manage_guild):
+            embed = discord.Embed(
+                title="エラー！", description="追加した人かサーバーの管理者しか削除できません",
+                color=discord.Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        # 行がなければ展開されないので、他のプロセスのスケジューラにも伝えなくてよい
+        await main_db.delete_rta_schedule(schedule["id"])
+        self.scheduler.remove_schedule(schedule["id"])
+        embed = discord.Embed(
+            title="削除しました",
+            description=(
+                f"<#{schedule['channel']}>の{int(schedule['interval_sec'] // 60)}分ごとのRTA"
+                "（追加済みの次の回はそのまま行われます）"
+            ),
+            color=discord.Color.blue()
+        )
+        logger.info(f"繰り返しのRTA(id: {schedule['id']})を削除しました。")
+        await ctx.response.send_message(embed=embed)
+
+    @ac.command(name="rta_standings", description="開催中のRTAの途中経過を表示")
+    @ac.guild_only()
+    async def rta_standings(self, ctx: discord.Interaction):
+        rtas = self.active.get(ctx.channel_id)  # type: ignore
+        if not rtas:
+            embed = discord.Embed(
+                title="エラー！", description="このチャンネルで開催中のRTAはありません",
+                color=discord.Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        embeds = []
+        for rta in rtas[:10]:
+            board = rta.board
+            embed = discord.Embed(
+                title="途中経過",
+                description=f"<t:{int(rta.timestamp)}>のRTA ({len(board)}人)",
+                color=discord.Color.blue()
+            )
+            for j, (user_id, diff) in enumerate(board.top(10)):
+                embed.add_field(name=f"{j+1}位", value=f"<@{user_id}> {diff}秒")
+            rank = board.rank(ctx.user.id)
+            if rank is not None:
+                embed.set_footer(text=f"あなたは{rank}位 ({board.get(ctx.user.id)}秒)")
+            embeds.append(embed)
+        await ctx.response.send_message(embeds=embeds)
+
+    @ac.command(name="rta_stats", description="このサーバーのRTAの成績を表示")
+    @ac.guild_only()
+    async def rta_stats(self, ctx: discord.Interaction, user: discord.Member | None = None):
+        if ctx.guild_id is None:
+            raise
+        guild = await main_db.get_guild_stats(ctx.guild_id)
+        if guild is None:
+            embed = discord.Embed(
+                title="エラー！", description="まだ終わったRTAがありません",
+                color=discord.Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        embed = discord.Embed(title="このサーバーのRTAの成績", color=discord.Color.blue())
+        embed.add_field(name="開催数", value=f"{guild['rtas']}回")
+        embed.add_field(name="参加者数(のべ)", value=f"{guild['attempts']}人")
+        if guild["attempts"]:
+            embed.add_field(
+                name="平均の差", value=f"{round(guild['total_abs_diff'] / guild['attempts'], 3)}秒"
+            )
+        if guild["best_user_id"] is not None:
+            embed.add_field(
+                name="最高記録", value=f"<@{guild['best_user_id']}> {guild['best_diff']}秒",
+                inline=False
+            )
+        top = [
+            f"{j+1}. <@{k['user_id']}> {k['wins']}勝/{k['attempts']}回 (最高{k['best_diff']}秒)"
+            for j, k in enumerate(await main_db.get_top_user_stats(ctx.guild_id))
+        ]
+        embed.add_field(name="勝利数ランキング", value="\n".join(top) or "なし", inline=False)
+
+        target = user or ctx.user
+        stats = await main_db.get_user_stats(ctx.guild_id, target.id)
+        if stats is not None:
+            embed.add_field(
+                name=f"{target.display_name}の成績",
+                value=(
+                    f"{stats['attempts']}回参加、{stats['wins']}勝、"
+                    f"平均{round(stats['total_abs_diff'] / stats['attempts'], 3)}秒、"
+                    f"最高{stats['best_diff']}秒"
+                ),
+                inline=False
+            )
+        await ctx.response.send_message(embed=embed)
+
     @ac.command(name="get_rta", description="設定されたスケジュールを表示")
     @ac.describe(sort="ソートの順番")
     @ac.choices(
@@ -288,22 +556,75 @@ class RTACog(commands.Cog):
         if ctx.channel_id is None:
             raise
 
-        all_rta = main_db.get_all_rta(sort_type=sort_type)
-        data = filter(lambda x: x["guild_id"] == ctx.guild_id, all_rta)
+        if ctx.guild_id is None:
+            raise
+
+        view = RTAPages(ctx.user.id, ctx.guild_id, sort_type)
+        await ctx.response.send_message(embed=await view.first_page(), view=view)
+
+
+class RTAPages(discord.ui.View):
+    """/get_rtaのページ送り
+
+    ボタンが押されるたびに次のページの分だけ取得します
+    """
+    PER_PAGE = 10
+
+    def __init__(self, user_id: int, guild_id: int, sort_type: db.SortType) -> None:
+        super().__init__(timeout=180)
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.sort_type = sort_type
+        self.page = 0
+        self.total = 0
+        # cursors[n]はnページ目の直前の行の(date, id)
+        self.cursors: list[tuple[float, int] | None] = [None]
+        self.rows: list = []
+
+    @property
+    def pages(self) -> int:
+        return max(math.ceil(self.total / self.PER_PAGE), 1)
+
+    async def first_page(self) -> discord.Embed:
+        self.total = await main_db.count_guild_rta(self.guild_id)
+        return await self._load()
+
+    async def _load(self) -> discord.Embed:
+        self.rows = await main_db.get_guild_rta(
+            self.guild_id, self.sort_type, self.PER_PAGE, self.cursors[self.page]
+        )
+        if self.rows and len(self.cursors) == self.page + 1:
+            last = self.rows[-1]
+            self.cursors.append((last["date"], last["id"]))
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page + 1 >= self.pages
+        return self._embed()
+
+    def _embed(self) -> discord.Embed:
         resp = discord.Embed(title="このサーバーでの結果", colour=discord.Color.blurple())
-        for i, j in enumerate(data):
+        start = self.page * self.PER_PAGE
+        for i, j in enumerate(self.rows, start):
             date = int(j["date"])
             ch = j["channel_id"]
             resp.add_field(name=f"{i+1}. <#{ch}>", value=f"<t:{date}:f>")
-        await ctx.response.send_message(embed=resp)
+        resp.set_footer(text=f"{self.page + 1}/{self.pages}ページ (全{self.total}件)")
+        return resp
+
+    async def interaction_check(self, ctx: discord.Interaction) -> bool:
+        return ctx.user.id == self.user_id
+
+    @discord.ui.button(label="前へ", style=discord.ButtonStyle.gray)
+    async def prev_page(self, ctx: discord.Interaction, button: discord.ui.Button):
+        self.page = max(self.page - 1, 0)
+        await ctx.response.edit_message(embed=await self._load(), view=self)
+
+    @discord.ui.button(label="次へ", style=discord.ButtonStyle.gray)
+    async def next_page(self, ctx: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await ctx.response.edit_message(embed=await self._load(), view=self)
 
 
 async def setup(bot: Bot):
     print("Common Commands added")
     await bot.add_cog(CommonCommands(bot))
     await bot.add_cog(RTACog(bot))
-
-
-async def teardown(bot: Bot):
-    main_db.db.close()
-    print("db closed")
@@ -1,27 +1,56 @@
+import asyncio
+import base64
 import logging
 import time
 import uuid
-from io import BytesIO
+from os import getenv
 
 import coloredlogs
 import discord
-import webuiapi
 from discord import Color, Interaction
 from discord import app_commands as ac
 from discord.ext.commands import Bot
 
+from db import get_db_path, get_shared_db
 from utils import stable_diffusion as sd
+from utils.completion import CompletionEngine
+from utils.image_output import DEFAULT_SIZE_LIMIT, EncodedImage, ImageFormat, ImagePipeline, sniff_ext
+from utils.sd_cache import ResultCache, cache_key
+from utils.sd_pool import NoBackendError, pool
+from utils.sd_progress import ProgressReporter
+from utils.sd_queue import QueueFullError
 
-PORT = 7861
 coloredlogs.install()
 logger = logging.getLogger(__name__)
 
-_api = webuiapi.WebUIApi(port=PORT)
-logger.info("Initialized sd-api")
-_sd_models = sd.ModelsAPI(_api)
-logger.debug("Initialized sd.ModelsAPI")
-_sd_models.set_current_options(sd.Defaults.to_options())
-logger.info("Applied sd-options")
+_backend = pool
+_catalog = _backend.catalog
+_pipeline = ImagePipeline()
+_cache = ResultCache(get_db_path().parent / "sd_cache")
+_db = get_shared_db()
+# 順番待ちの件数を更新する間隔(秒)
+POSITION_INTERVAL = 3.0
+
+
+_FORMAT_CHOICES = [
+    ac.Choice(name="そのまま", value=ImageFormat.ORIGINAL.value),
+    ac.Choice(name="PNG(最適化)", value=ImageFormat.PNG.value),
+    ac.Choice(name="WebP", value=ImageFormat.WEBP.value),
+    ac.Choice(name="JPEG", value=ImageFormat.JPEG.value),
+]
+
+
+async def _resolve_format(ctx: Interaction, image_format: str | None) -> ImageFormat:
+    """指定がなければユーザー、サーバーの順に設定された形式を使う"""
+    if image_format is None:
+        try:
+            image_format = await _db.get_image_format(ctx.user.id, ctx.guild_id)
+        except Exception:
+            logger.warning("画像の形式の設定を読めませんでした", exc_info=True)
+    try:
+        return ImageFormat(image_format or ImageFormat.ORIGINAL.value)
+    except ValueError:
+        return ImageFormat.ORIGINAL
 
 
 class AutoCompletions:
@@ -30,30 +59,34 @@ class AutoCompletions:
     Returns:
         List[app_commands.Choice]: 候補のリスト
     """
+    samplers = CompletionEngine(i.value for i in sd.Samplers)
+
     @classmethod
     async def model(cls, ctx: Interaction, inputted: str) -> list[ac.Choice]:
-        models = _sd_models.get_models()
+        if not _backend.ready:
+            return []
+        models = await _catalog.models.get()
         if isinstance(ctx.channel, discord.TextChannel) and ctx.channel.is_nsfw():
             return await cls._candidate(inputted, models)
         else:
-            models = [i for i in models if "nsfw" not in i]
-            return await cls._candidate(inputted, models)
+            return await cls._candidate(inputted, models, exclude="nsfw")
 
     @classmethod
     async def vae(cls, ctx: Interaction, inputted: str) -> list[ac.Choice]:
-        vaes = _sd_models.get_vaes()
+        if not _backend.ready:
+            return []
+        vaes = await _catalog.vaes.get()
         return await cls._candidate(inputted, vaes)
 
     @classmethod
     async def sampler(cls, ctx: Interaction, inputted: str) -> list[ac.Choice]:
-        samplers = [i.value for i in sd.Samplers]
-        return await cls._candidate(inputted, samplers)
+        return await cls._candidate(inputted, cls.samplers)
 
     @staticmethod
-    async def _candidate(text: str, candidates: list) -> list[ac.Choice]:
-        if text == "":
-            return [ac.Choice(name=i, value=i) for i in candidates]
-        return [ac.Choice(name=i, value=i) for i in candidates if text.lower() in i.lower()]
+    async def _candidate(
+        text: str, candidates: CompletionEngine, exclude: str | None = None
+    ) -> list[ac.Choice]:
+        return [ac.Choice(name=i, value=i) for i in candidates.search(text, exclude=exclude)]
 
 
 class SDCog(ac.Group):
@@ -68,6 +101,14 @@ class SDCog(ac.Group):
         self.bot = bot
 
     @ac.command(name="txt2img")
+    @ac.describe(
+        image_format="画像の形式。省略すると/sd image_formatの設定。サイズの上限を超えるときは自動で圧縮されます",
+        batch_size="1回で同時に生成する枚数",
+        n_iter="生成を繰り返す回数",
+        grid="一覧の画像も付けるか",
+        live_preview="生成中の途中経過の画像を表示するか",
+    )
+    @ac.choices(image_format=_FORMAT_CHOICES)
     @ac.autocomplete(
         model=AutoCompletions.model,
         vae=AutoCompletions.vae,
@@ -86,32 +127,30 @@ class SDCog(ac.Group):
         steps: int = 20,
         seed: int = -1,
         cfg_scale: float = 7.0,
-        ignore_default_negative_prompts: bool = False
+        ignore_default_negative_prompts: bool = False,
+        image_format: str | None = None,
+        batch_size: ac.Range[int, 1, 4] = 1,
+        n_iter: ac.Range[int, 1, 2] = 1,
+        grid: bool = False,
+        live_preview: bool = False,
     ):
 
         option = sd.Defaults.to_options()
-
-        embed = None
-        if model and model not in _sd_models.get_models():
-            embed = discord.Embed(title="エラー！", description="モデルがありません", color=Color.red())
-        elif vae and vae not in _sd_models.get_vaes():
-            embed = discord.Embed(title="エラー！", description="VAEがありません", color=Color.red())
-        elif model:
+        if model:
             option.model = model
-        elif vae:
+        if vae:
             option.vae = vae
 
-        if embed:
-            await ctx.response.send_message(embed=embed, ephemeral=True)
-            return
-
-        embed = discord.Embed(title="生成中...", description="", color=Color.blue())
-        await ctx.response.send_message(embed=embed)
-
-        _sd_models.set_current_options(option)
-
         if sampler is None:
             sampler = sd.Defaults.SAMPLER  # dpm++ 2m karras
+        # ネガティブプロンプトを調整してからパラメータに入れる
+        _negative = list(map(lambda x: x.replace(" ", ""), negative_prompt.split(",")))
+        if not ignore_default_negative_prompts:
+            for i in reversed(sd.Defaults.NEGATIVE_PROMPTS):
+                if i not in _negative:
+                    negative_prompt = i + ", " + negative_prompt
+        if isinstance(ctx.channel, discord.TextChannel) and (not ctx.channel.is_nsfw()):
+            negative_prompt = "nsfw, " + negative_prompt
         params = {
             "prompt": prompt,
             "negative_prompt": negative_prompt,
@@ -122,36 +161,184 @@ class SDCog(ac.Group):
             "steps": steps,
             "seed": seed,
             "cfg_scale": cfg_scale,
-            "use_async": True,
+            "batch_size": batch_size,
+            "n_iter": n_iter,
         }
-        # ネガティブプロンプトを調整
-        _negative = list(map(lambda x: x.replace(" ", ""), params["negative_prompt"].split(",")))
-        if not ignore_default_negative_prompts:
-            for i in reversed(sd.Defaults.NEGATIVE_PROMPTS):
-                if i not in _negative:
-                    negative_prompt = i + ", " + negative_prompt
-        if isinstance(ctx.channel, discord.TextChannel) and (not ctx.channel.is_nsfw()):
-            negative_prompt = "nsfw, " + negative_prompt
+
+        fmt = await _resolve_format(ctx, image_format)
+
+        # seedが決まっていれば同じ画像になるので、前の結果があればそれを返す。
+        # キーにモデルとVAEが入っているので、当たればバックエンドの状態やモデルの有無は見ない
+        key = cache_key(option, params)
+        cached = await _cache.get(key) if key else None
+        if cached is not None:
+            await ctx.response.defer()
+            await _send_result(ctx, cached, 0, prompt, negative_prompt, fmt, grid, cached=True)
+            return
+
+        embed = None
+        if _backend.state is sd.BackendState.WARMING_UP:
+            embed = discord.Embed(
+                title="エラー！", description="バックエンドの準備中です。少し待ってからもう一度試してください",
+                color=Color.red()
+            )
+        elif not _backend.ready:
+            embed = discord.Embed(
+                title="エラー！", description="バックエンドに接続できません", color=Color.red()
+            )
+        elif model and model not in await _catalog.models.get():
+            embed = discord.Embed(title="エラー！", description="モデルがありません", color=Color.red())
+        elif vae and vae not in await _catalog.vaes.get():
+            embed = discord.Embed(title="エラー！", description="VAEがありません", color=Color.red())
+        if embed:
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        try:
+            job = _backend.submit(ctx.user.id, option, params)
+        except QueueFullError:
+            embed = discord.Embed(
+                title="エラー！", description="生成待ちのリクエストが多すぎます", color=Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+        except NoBackendError:
+            embed = discord.Embed(
+                title="エラー！", description="そのモデルを使えるバックエンドがありません", color=Color.red()
+            )
+            await ctx.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        position = _backend.position(job)
+        embed = discord.Embed(title="生成中...", description="", color=Color.blue())
+        if position:
+            embed.description = f"順番待ち: {position}件"
+        await ctx.response.send_message(embed=embed)
+        if position:
+            # 始まるまで、順番が進んだら表示を更新する
+            while not job.started.is_set():
+                try:
+                    await asyncio.wait_for(job.started.wait(), POSITION_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                current = _backend.position(job)
+                if current and current != position:
+                    position = current
+                    embed.description = f"順番待ち: {position}件"
+                    await ctx.edit_original_response(embed=embed)
+            embed.description = ""
+            await ctx.edit_original_response(embed=embed)
+
+        async def update(progress: sd.Progress):
+            embed.description = (
+                f"{_progress_bar(progress.progress)} {int(progress.progress * 100)}%"
+                f"（残り約{round(progress.eta)}秒）"
+            )
+            preview = _preview_file(progress.image) if progress.image else None
+            if preview:
+                embed.set_image(url=f"attachment://{preview.filename}")
+                await ctx.edit_original_response(embed=embed, attachments=[preview])
+            else:
+                await ctx.edit_original_response(embed=embed)
 
         s_time = time.perf_counter()
-        img = await _api.txt2img(**params)  # type: ignore
+        async with ProgressReporter(job, update, preview=live_preview):
+            img = await job
         p_time = time.perf_counter() - s_time
+        if key:
+            await _cache.put(key, img)
+        await _send_result(ctx, img, p_time, prompt, negative_prompt, fmt, grid)
+
+    @ac.command(name="image_format", description="txt2imgの画像の形式の既定値を設定します")
+    @ac.describe(
+        image_format="画像の形式。省略すると設定を消します",
+        scope="自分だけか、このサーバー全体か(サーバーの管理者のみ)",
+    )
+    @ac.choices(
+        image_format=_FORMAT_CHOICES,
+        scope=[ac.Choice(name="自分", value="user"), ac.Choice(name="サーバー", value="guild")],
+    )
+    async def image_format(
+        self, ctx: Interaction, image_format: str | None = None, scope: str = "user"
+    ):
+        if scope == "guild":
+            permissions = getattr(ctx.user, "guild_permissions", None)
+            if ctx.guild_id is None or not (permissions and permissions.manage_guild):
+                embed = discord.Embed(
+                    title="エラー！", description="サーバーの設定は管理者しか変更できません",
+                    color=Color.red()
+                )
+                await ctx.response.send_message(embed=embed, ephemeral=True)
+                return
+            target = ctx.guild_id
+        else:
+            target = ctx.user.id
+
+        await _db.set_image_format(scope, target, image_format)
+        where = "このサーバー" if scope == "guild" else "あなた"
+        if image_format is None:
+            description = f"{where}の設定を消しました"
+        else:
+            name = next(i.name for i in _FORMAT_CHOICES if i.value == image_format)
+            description = f"{where}の既定の形式を{name}にしました"
+        embed = discord.Embed(title="設定しました", description=description, color=Color.blue())
+        await ctx.response.send_message(embed=embed, ephemeral=True)
+
+
+async def _send_result(
+    ctx: Interaction,
+    img: sd.GenerationResult,
+    p_time: float,
+    prompt: str,
+    negative_prompt: str,
+    fmt: ImageFormat,
+    grid: bool,
+    cached: bool = False,
+):
+    # 1枚だけなら一覧は作らない
+    grid = grid and len(img.images) > 1
+    # 上限は1メッセージの合計なので枚数で割る
+    limit = ctx.guild.filesize_limit if ctx.guild else DEFAULT_SIZE_LIMIT
+    limit //= len(img.images) + int(grid)
+    tasks = [_pipeline.prepare(i, fmt, limit) for i in img.images]
+    if grid:
+        tasks.append(_pipeline.prepare_grid(img.images, limit))
+    encoded = await asyncio.gather(*tasks)
+    name = str(uuid.uuid4()).replace("-", "")
+    attachments = [j.to_file(f"{name}_{i}") for i, j in enumerate(encoded)]
+
+    seeds = img.info.get("all_seeds") or [img.info["seed"]]
+    title = "生成完了（キャッシュ）" if cached else f"生成完了（{round(p_time, 2)}秒）"
+    result = discord.Embed(title=title, color=Color.blue())
+    result.add_field(name="プロンプト", value=prompt[:1024])
+    result.add_field(name="ネガティブプロンプト", value=negative_prompt[:1024])
+    result.add_field(name="Seed", value=", ".join(map(str, seeds))[:1024], inline=False)
+    result.add_field(name="モデル", value=img.info["sd_model_name"], inline=False)
+    # 一覧があればそれを、なければ1枚目を表示する
+    result.set_image(url=f"attachment://{attachments[-1 if grid else 0].filename}")
+    await ctx.edit_original_response(embed=result, attachments=attachments)
 
-        img_bytes = BytesIO()
-        img.image.save(img_bytes, format="png")
-        img_bytes.seek(0)  # ここ重要
-        img_filename = str(uuid.uuid4()).replace("-", "") + ".png"
 
-        result = discord.Embed(title=f"生成完了（{round(p_time, 2)}秒）", color=Color.blue())
-        result.add_field(name="プロンプト", value=prompt[:1024])
-        result.add_field(name="ネガティブプロンプト", value=negative_prompt[:1024])
-        result.add_field(name="Seed", value=str(img.info["seed"]), inline=False)
-        result.add_field(name="モデル", value=img.info["sd_model_name"], inline=False)
-        attach = discord.File(img_bytes, filename=img_filename)
-        result.set_image(url=f"attachment://{img_filename}")
-        await ctx.edit_original_response(embed=result, attachments=[attach])
+def _progress_bar(progress: float, width: int = 10) -> str:
+    filled = round(progress * width)
+    return "█" * filled + "░" * (width - filled)
+
+
+def _preview_file(image: str) -> discord.File | None:
+    data = base64.b64decode(image)
+    ext = sniff_ext(data)
+    if ext is None:
+        return None
+    return EncodedImage(data, ext).to_file("preview")
 
 
 async def setup(bot: Bot):
+    _cache.max_bytes = int(getenv("SD_CACHE_MAX_MB", 512)) * 1024 ** 2
+    await _cache.load()
     bot.tree.add_command(SDCog(bot, name="sd"))
     print("Stable Diffusion cog added")
+
+
+async def teardown(bot: Bot):
+    await _backend.close_queues()
+    _pipeline.close()
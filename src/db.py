@@ -1,6 +1,13 @@
+import asyncio
+import logging
+import math
 import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from enum import Enum
 from pathlib import Path
 from textwrap import dedent
@@ -8,9 +15,12 @@ from textwrap import dedent
 import discord
 
 import utils.botutils as botutils
+from utils import metrics
 
+logger = logging.getLogger(__name__)
 
-def get_db():
+
+def get_db_path() -> Path:
     p = Path.cwd()
     if p.name == "src":
         p = p.parent
@@ -18,7 +28,11 @@ def get_db():
         p = p.parent.parent
     db = p.joinpath("db")
     db.mkdir(exist_ok=True)
-    return sqlite3.connect(db.joinpath("main.sqlite"))
+    return db.joinpath("main.sqlite")
+
+
+def get_db():
+    return sqlite3.connect(get_db_path())
 
 
 def init_db(db: sqlite3.Connection):
@@ -58,9 +72,184 @@ def init_db(db: sqlite3.Connection):
         """
     ))
     db.commit()
+    migrate(db)
     db.row_factory = sqlite3.Row
 
 
+def _migrate_ranking_key(db: sqlite3.Connection):
+    # 同じ(id, user_id)の記録が複数あれば一番良いものだけ残す
+    db.execute(dedent(
+        """
+        DELETE FROM rta_ranking WHERE rowid NOT IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (
+                    PARTITION BY id, user_id ORDER BY ABS(diff), rowid
+                ) AS rn FROM rta_ranking
+            ) WHERE rn = 1
+        );
+        """
+    ))
+    db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS rta_ranking_id_user ON rta_ranking(id, user_id);"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS rta_db_channel_date ON rta_db(channel_id, date);"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS rta_db_guild_date ON rta_db(guild_id, date);"
+    )
+
+
+def _migrate_schedule_cache(db: sqlite3.Connection):
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS school_schedule_cache(
+            day INTEGER PRIMARY KEY,
+            status INTEGER,
+            body TEXT,
+            fetched_at REAL
+        ) STRICT;
+        """
+    ))
+
+
+def _migrate_rta_schedule_index(db: sqlite3.Connection):
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS rta_schedule_guild_date ON rta_schedule(guild, start_date);"
+    )
+
+
+def _migrate_rta_stats(db: sqlite3.Connection):
+    # 終わったRTAの結果をサーバーとユーザーごとに足していく集計
+    # rta_dbの行は終了時に消しているので、過去の分は集計できない
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS rta_user_stats(
+            guild_id INTEGER,
+            user_id INTEGER,
+            attempts INTEGER,
+            wins INTEGER,
+            total_abs_diff REAL,
+            best_diff REAL,
+            PRIMARY KEY(guild_id, user_id)
+        ) STRICT;
+        """
+    ))
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS rta_user_stats_wins ON rta_user_stats(guild_id, wins);"
+    )
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS rta_guild_stats(
+            guild_id INTEGER PRIMARY KEY,
+            rtas INTEGER,
+            attempts INTEGER,
+            total_abs_diff REAL,
+            best_diff REAL,
+            best_user_id INTEGER
+        ) STRICT;
+        """
+    ))
+
+
+def _migrate_cluster(db: sqlite3.Connection):
+    # 複数のプロセスで動かすときのリーダーのリースと、プロセス間で渡すイベント
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS leases(
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires_at REAL
+        ) STRICT;
+        """
+    ))
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS cluster_events(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            target INTEGER,
+            event TEXT,
+            rta_id INTEGER,
+            created_at REAL
+        ) STRICT;
+        """
+    ))
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS cluster_events_target ON cluster_events(target, seq);"
+    )
+
+
+def _migrate_schedule_cache_date(db: sqlite3.Connection):
+    # 日にちだけだと月をまたぐと前の月の時程を返してしまうので、日付で持つ
+    # 中身はキャッシュなので作り直す
+    db.execute("DROP TABLE IF EXISTS school_schedule_cache;")
+    db.execute(dedent(
+        """
+        CREATE TABLE school_schedule_cache(
+            date TEXT PRIMARY KEY,
+            status INTEGER,
+            body TEXT,
+            fetched_at REAL
+        ) STRICT;
+        """
+    ))
+
+
+def _migrate_image_format(db: sqlite3.Connection):
+    # /sd txt2imgの画像の形式の既定値。scopeは"user"か"guild"
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS image_format_prefs(
+            scope TEXT,
+            target INTEGER,
+            format TEXT,
+            PRIMARY KEY(scope, target)
+        ) STRICT;
+        """
+    ))
+
+
+def _migrate_rta_started(db: sqlite3.Connection):
+    # 開始のお知らせを送ったRTA。複数のプロセスや再起動で2回送らないようにする
+    db.execute(dedent(
+        """
+        CREATE TABLE IF NOT EXISTS rta_started(
+            id INTEGER PRIMARY KEY
+        ) STRICT;
+        """
+    ))
+
+
+# PRAGMA user_versionの値がそのまま適用済みのマイグレーションの数になる
+MIGRATIONS = [
+    _migrate_ranking_key,
+    _migrate_schedule_cache,
+    _migrate_rta_schedule_index,
+    _migrate_rta_stats,
+    _migrate_cluster,
+    _migrate_schedule_cache_date,
+    _migrate_image_format,
+    _migrate_rta_started,
+]
+
+
+def migrate(db: sqlite3.Connection):
+    version = db.execute("PRAGMA user_version;").fetchone()[0]
+    while version < len(MIGRATIONS):
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            # 他の接続が先に適用しているかもしれないので確認し直す
+            version = db.execute("PRAGMA user_version;").fetchone()[0]
+            if version < len(MIGRATIONS):
+                MIGRATIONS[version](db)
+                version += 1
+                db.execute(f"PRAGMA user_version = {version};")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+
 class SortType(Enum):
     ASC = "ASC"
     DESC = "DESC"
@@ -120,6 +309,42 @@ class BotDB:
     ):
         return list(self._get_rta(id, channel_id, timestamp, sort_type))
 
+    def get_guild_rta(
+        self,
+        guild_id: int,
+        sort_type: SortType = SortType.ASC,
+        limit: int = 10,
+        after: tuple[float, int] | None = None,
+    ) -> list[sqlite3.Row]:
+        """サーバーのRTAを1ページ分取得する
+
+        Args:
+            after: 前のページの最後の行の(date, id)。Noneなら最初のページ
+        """
+        if not (isinstance(guild_id, int) and isinstance(sort_type, SortType)):
+            raise ValueError("SQLインジェクションやめて!!!")
+        op = ">" if sort_type is SortType.ASC else "<"
+        where = "guild_id = ?"
+        args: list = [guild_id]
+        if after is not None:
+            where += f" AND (date, id) {op} (?, ?)"
+            args.extend(after)
+        args.append(limit)
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                f"SELECT * FROM rta_db WHERE {where} "
+                f"ORDER BY date {sort_type.value}, id {sort_type.value} LIMIT ?;",
+                args,
+            )
+            return cur.fetchall()
+
+    def count_guild_rta(self, guild_id: int) -> int:
+        if not isinstance(guild_id, int):
+            raise ValueError
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT COUNT(*) FROM rta_db WHERE guild_id = ?;", (guild_id,))
+            return cur.fetchone()[0]
+
     def get_near_rta(self, date: int, channel_id: int):
         if not (isinstance(date, int) and isinstance(channel_id, int)):
             raise ValueError("SQLインジェクションやめてね")
@@ -171,32 +396,28 @@ class BotDB:
             raise ValueError
         cur = self.db.cursor()
         cur.execute("DELETE FROM rta_db WHERE id = ?", (id,))
+        cur.execute("DELETE FROM rta_started WHERE id = ?", (id,))
         cur.close()
         self.db.commit()
         return True
 
-    def append_ranking(self, id: int, user_id: int, time: float):
-        if not self.get_rta(id):
-            raise ValueError("そのidは存在しなかった")
-        cur = self.db.cursor()
-        cur.execute("SELECT * FROM rta_ranking WHERE id = ? AND user_id = ?;", (id, user_id))
-        existing_row = cur.fetchone()
+    _UPSERT_RANKING = dedent(
+        """
+        INSERT INTO rta_ranking VALUES (?, ?, ?)
+        ON CONFLICT(id, user_id) DO UPDATE SET diff = excluded.diff
+        WHERE ABS(excluded.diff) < ABS(diff);
+        """
+    )
 
-        if existing_row:
-            # 存在する場合はUPDATE文で置き換える
-            cur.execute(
-                "UPDATE rta_ranking SET diff = ? WHERE id = ? AND user_id = ?;",
-                (time, id, user_id),
-            )
-        else:
-            # 存在しない場合は挿入
-            cur.execute(
-                "INSERT INTO rta_ranking VALUES (?, ?, ?);",
-                (id, user_id, time)
-            )
+    def append_ranking(self, id: int, user_id: int, time: float):
+        """記録を追加する。既にある記録より良いときだけ置き換える"""
+        with self.db:
+            self.db.execute(self._UPSERT_RANKING, (id, user_id, time))
 
-        cur.close()
-        self.db.commit()
+    def append_rankings(self, rows: list[tuple[int, int, float]]):
+        """(id, user_id, diff)の組をまとめて1トランザクションで書き込む"""
+        with self.db:
+            self.db.executemany(self._UPSERT_RANKING, rows)
 
     def get_ranking(self, id: int):
         if not isinstance(id, int):
@@ -225,6 +446,200 @@ class BotDB:
         if d is not None:
             return d["diff"]
 
+    _UPSERT_USER_STATS = dedent(
+        """
+        INSERT INTO rta_user_stats VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET
+            attempts = attempts + 1,
+            wins = wins + excluded.wins,
+            total_abs_diff = total_abs_diff + excluded.total_abs_diff,
+            best_diff = CASE WHEN ABS(excluded.best_diff) < ABS(best_diff)
+                THEN excluded.best_diff ELSE best_diff END;
+        """
+    )
+    _UPSERT_GUILD_STATS = dedent(
+        """
+        INSERT INTO rta_guild_stats VALUES (?, 1, ?, ?, ?, ?)
+        ON CONFLICT(guild_id) DO UPDATE SET
+            rtas = rtas + 1,
+            attempts = attempts + excluded.attempts,
+            total_abs_diff = total_abs_diff + excluded.total_abs_diff,
+            best_user_id = CASE WHEN best_diff IS NULL OR ABS(excluded.best_diff) < ABS(best_diff)
+                THEN excluded.best_user_id ELSE best_user_id END,
+            best_diff = CASE WHEN best_diff IS NULL OR ABS(excluded.best_diff) < ABS(best_diff)
+                THEN excluded.best_diff ELSE best_diff END;
+        """
+    )
+
+    def start_rta(self, id: int) -> bool:
+        """RTAを開始済みにする。初めてならTrue、既に開始済みか消えていればFalseを返す"""
+        with self.db:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO rta_started SELECT id FROM rta_db WHERE id = ?;", (id,)
+            )
+            return cur.rowcount == 1
+
+    def finish_rta(self, id: int, results: list[tuple[int, float]]) -> bool:
+        """RTAを消し、順位の順の(user_id, diff)を集計に足す
+
+        1トランザクションで行うので、2回呼ばれても集計は1回分しか増えない。
+        既に消えていればFalseを返す。
+        """
+        with self.db:
+            row = self.db.execute("SELECT guild_id FROM rta_db WHERE id = ?;", (id,)).fetchone()
+            if row is None:
+                return False
+            guild_id = row["guild_id"]
+            self.db.execute("DELETE FROM rta_db WHERE id = ?;", (id,))
+            self.db.execute("DELETE FROM rta_started WHERE id = ?;", (id,))
+            self.db.executemany(
+                self._UPSERT_USER_STATS,
+                (
+                    (guild_id, user_id, int(i == 0), abs(diff), diff)
+                    for i, (user_id, diff) in enumerate(results)
+                ),
+            )
+            best_user, best = results[0] if results else (None, None)
+            self.db.execute(
+                self._UPSERT_GUILD_STATS,
+                (guild_id, len(results), sum(abs(i[1]) for i in results), best, best_user),
+            )
+        return True
+
+    def get_user_stats(self, guild_id: int, user_id: int) -> sqlite3.Row | None:
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                "SELECT * FROM rta_user_stats WHERE guild_id = ? AND user_id = ?;",
+                (guild_id, user_id),
+            )
+            return cur.fetchone()
+
+    def get_top_user_stats(self, guild_id: int, limit: int = 10) -> list[sqlite3.Row]:
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                dedent(
+                    """
+                    SELECT * FROM rta_user_stats WHERE guild_id = ?
+                    ORDER BY wins DESC, ABS(best_diff) LIMIT ?;
+                    """
+                ),
+                (guild_id, limit),
+            )
+            return cur.fetchall()
+
+    def get_guild_stats(self, guild_id: int) -> sqlite3.Row | None:
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT * FROM rta_guild_stats WHERE guild_id = ?;", (guild_id,))
+            return cur.fetchone()
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """リースを取るか延長する。他のプロセスが有効なリースを持っていればFalse"""
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                dedent(
+                    """
+                    INSERT INTO leases VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        holder = excluded.holder, expires_at = excluded.expires_at
+                    WHERE holder = excluded.holder OR expires_at < ?;
+                    """
+                ),
+                (name, holder, now + ttl, now),
+            )
+            row = self.db.execute("SELECT holder FROM leases WHERE name = ?;", (name,)).fetchone()
+        return row is not None and row["holder"] == holder
+
+    def release_lease(self, name: str, holder: str):
+        with self.db:
+            self.db.execute("DELETE FROM leases WHERE name = ? AND holder = ?;", (name, holder))
+
+    def post_cluster_event(self, target: int, event: str, rta_id: int):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO cluster_events(target, event, rta_id, created_at) VALUES (?, ?, ?, ?);",
+                (target, event, rta_id, time.time()),
+            )
+
+    def take_cluster_events(self, targets: list[int]) -> list[sqlite3.Row]:
+        """targets宛てのイベントを古い順に取り出して消す"""
+        marks = ",".join("?" * len(targets))
+        rows = self.db.execute(
+            f"SELECT * FROM cluster_events WHERE target IN ({marks}) ORDER BY seq;", targets
+        ).fetchall()
+        if not rows:
+            return []
+        # 後から書き込まれたイベントは必ずseqが大きいので、取り出した分だけ消える
+        with self.db:
+            self.db.execute(
+                f"DELETE FROM cluster_events WHERE target IN ({marks}) AND seq <= ?;",
+                (*targets, rows[-1]["seq"]),
+            )
+        return rows
+
+    def prune_cluster_events(self, max_age: float) -> int:
+        """max_age秒より古いイベントを消して、消した数を返す
+
+        受け持つプロセスがいないシャード宛てのイベントは誰も取り出さないので、ここで消す。
+        """
+        with self.db:
+            cur = self.db.execute(
+                "DELETE FROM cluster_events WHERE created_at < ?;", (time.time() - max_age,)
+            )
+        return cur.rowcount
+
+    def get_image_format(self, user_id: int, guild_id: int | None) -> str | None:
+        """ユーザーの設定、なければサーバーの設定"""
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                dedent(
+                    """
+                    SELECT format FROM image_format_prefs
+                    WHERE (scope = 'user' AND target = ?) OR (scope = 'guild' AND target = ?)
+                    ORDER BY scope = 'user' DESC LIMIT 1;
+                    """
+                ),
+                (user_id, guild_id),
+            )
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def set_image_format(self, scope: str, target: int, format: str | None):
+        """formatがNoneなら設定を消す"""
+        with self.db:
+            if format is None:
+                self.db.execute(
+                    "DELETE FROM image_format_prefs WHERE scope = ? AND target = ?;",
+                    (scope, target),
+                )
+            else:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO image_format_prefs VALUES (?, ?, ?);",
+                    (scope, target, format),
+                )
+
+    def get_school_schedules(self, since: date) -> list[sqlite3.Row]:
+        """since以降の日付の時程"""
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                "SELECT * FROM school_schedule_cache WHERE date >= ?;", (since.isoformat(),)
+            )
+            return cur.fetchall()
+
+    def set_school_schedule(self, day: date, status: int, body: str | None, fetched_at: float):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO school_schedule_cache VALUES (?, ?, ?, ?);",
+                (day.isoformat(), status, body, fetched_at),
+            )
+
+    def delete_school_schedules(self, before: date):
+        """beforeより前の日付の時程を消す"""
+        with self.db:
+            self.db.execute(
+                "DELETE FROM school_schedule_cache WHERE date < ?;", (before.isoformat(),)
+            )
+
     def add_rta_schedule(
         self,
         date: datetime,
@@ -232,8 +647,338 @@ class BotDB:
         count: int,
         ctx: discord.Interaction,
     ):
-        cur = self.db.cursor()
-        # wip
+        """繰り返しのRTAを追加する
+
+        rta_dbには次の1回分だけを、開始の少し前に ``expand_rta_schedule`` で追加する。
+        start_dateはいつも次の回の時刻になる。
+        """
+        if isinstance(interval, timedelta):
+            interval = int(interval.total_seconds())
+        if ctx.channel_id is None:
+            raise ValueError("channel_id is None")
+        if interval <= 0 or count <= 0:
+            raise ValueError("interval and count must be positive")
+
+        id = botutils.generate_secure_id(10)
+        with self.db:
+            self.db.execute(
+                "INSERT INTO rta_schedule VALUES (?,?,?,?,?,?,?);",
+                (
+                    id,
+                    ctx.guild_id,
+                    ctx.channel_id,
+                    ctx.user.id,
+                    date.timestamp(),
+                    float(interval),
+                    count,
+                ),
+            )
+        return id
+
+    def get_near_rta_schedule(self, date: int, channel_id: int) -> list[sqlite3.Row]:
+        """dateの前後60秒に、まだ展開されていない回があるチャンネルの繰り返しのRTA"""
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT * FROM rta_schedule WHERE channel = ?;", (channel_id,))
+            rows = cur.fetchall()
+        near = []
+        for sc in rows:
+            k = (date - sc["start_date"]) / sc["interval_sec"]
+            for i in {math.floor(k), math.ceil(k)}:
+                at = sc["start_date"] + i * sc["interval_sec"]
+                if 0 <= i < sc["remaining_count"] and abs(at - date) <= 60:
+                    near.append(sc)
+                    break
+        return near
+
+    def get_rta_schedule(self, id: int) -> sqlite3.Row | None:
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT * FROM rta_schedule WHERE id = ?;", (id,))
+            return cur.fetchone()
+
+    def get_all_rta_schedule(self) -> list[sqlite3.Row]:
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT * FROM rta_schedule ORDER BY start_date;")
+            return cur.fetchall()
+
+    def get_guild_rta_schedule(self, guild_id: int, limit: int = 25) -> list[sqlite3.Row]:
+        with closing(self.db.cursor()) as cur:
+            cur.execute(
+                "SELECT * FROM rta_schedule WHERE guild = ? ORDER BY start_date LIMIT ?;",
+                (guild_id, limit),
+            )
+            return cur.fetchall()
+
+    def count_guild_rta_schedule(self, guild_id: int) -> int:
+        with closing(self.db.cursor()) as cur:
+            cur.execute("SELECT COUNT(*) FROM rta_schedule WHERE guild = ?;", (guild_id,))
+            return cur.fetchone()[0]
+
+    def expand_rta_schedule(
+        self, id: int, now: float, margin: float = 15
+    ) -> tuple[sqlite3.Row | None, sqlite3.Row | None]:
+        """繰り返しのRTAの次の回をrta_dbに追加し、スケジュールを1回分進める
+
+        止まっていた間に終わった回は飛ばす。同じチャンネルの近い時間に
+        RTAがあればその回は追加しない。
+
+        Returns:
+            (追加したrta_dbの行, 進めたスケジュールの行)。終わったスケジュールは削除されNoneになる
+        """
+        with self.db:
+            sc = self.get_rta_schedule(id)
+            if sc is None:
+                return None, None
+            date = sc["start_date"]
+            remaining = sc["remaining_count"]
+            interval = sc["interval_sec"]
+            if date + margin <= now:
+                skip = math.floor((now - margin - date) / interval) + 1
+                date += skip * interval
+                remaining -= skip
+
+            rta = None
+            if remaining > 0 and not self.get_near_rta(int(date), sc["channel"]):
+                rta_id = botutils.generate_secure_id(10)
+                self.db.execute(
+                    "INSERT INTO rta_db VALUES (?,?,?,?,?,?);",
+                    (rta_id, sc["guild"], sc["channel"], sc["created_user"], date, int(now)),
+                )
+                rta = self.get_rta(rta_id)[0]
+
+            remaining -= 1
+            if remaining <= 0:
+                self.db.execute("DELETE FROM rta_schedule WHERE id = ?;", (id,))
+                return rta, None
+            self.db.execute(
+                "UPDATE rta_schedule SET start_date = ?, remaining_count = ? WHERE id = ?;",
+                (date + interval, remaining, id),
+            )
+            return rta, self.get_rta_schedule(id)
+
+    def delete_rta_schedule(self, id: int):
+        with self.db:
+            self.db.execute("DELETE FROM rta_schedule WHERE id = ?;", (id,))
+        return True
+
+
+DB_SECONDS = metrics.registry.histogram(
+    "bot_db_query_seconds", "DBのメソッドの時間(スレッドの空き待ちを含む)", ("method", "status")
+)
+DB_PENDING = metrics.registry.gauge("bot_db_pending_queries", "DBの処理待ちと処理中の数")
+# 開いているAsyncBotDB全部の処理待ちを合計して出す
+_open_dbs: "weakref.WeakSet[AsyncBotDB]" = weakref.WeakSet()
+metrics.registry.on_collect("db", lambda: DB_PENDING.set(sum(i.pending for i in _open_dbs)))
+
+
+class AsyncBotDB:
+    """BotDBをイベントループの外で動かすラッパー
+
+    読み込みはスレッドプール上でスレッドごとの接続を使い、
+    書き込みは専用の1スレッドに直列化する。メソッドはBotDBと同じで、awaitして使う。
+
+    Args:
+        path (str | Path): データベースのパス
+        readers (int): 読み込み用スレッドの数
+    """
+    _READ_METHODS = (
+        "get_all_rta", "get_rta", "get_guild_rta", "count_guild_rta", "get_near_rta",
+        "get_ranking", "get_high_score", "get_school_schedules", "get_rta_schedule",
+        "get_near_rta_schedule", "get_image_format",
+        "get_all_rta_schedule", "get_guild_rta_schedule", "count_guild_rta_schedule",
+        "get_user_stats", "get_top_user_stats", "get_guild_stats",
+    )
+    _WRITE_METHODS = (
+        "add_rta", "delete_rta", "append_ranking", "append_rankings", "add_rta_schedule",
+        "set_school_schedule", "delete_school_schedules", "expand_rta_schedule",
+        "delete_rta_schedule", "start_rta", "finish_rta",
+        "acquire_lease", "release_lease", "post_cluster_event", "take_cluster_events",
+        "prune_cluster_events", "set_image_format",
+    )
+
+    def __init__(self, path: str | Path, readers: int = 4) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._dbs: list[BotDB] = []
+        # 先に書き込み用の接続を作ってスキーマを用意しておく
+        self._writer_db = self._connect()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="botdb-writer")
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="botdb-reader")
+        self.pending = 0
+        _open_dbs.add(self)
+
+    @classmethod
+    def get_default_db(cls):
+        return cls(get_db_path())
+
+    def _connect(self) -> BotDB:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        db = BotDB(conn)
+        with self._lock:
+            self._dbs.append(db)
+        return db
+
+    def _reader_db(self) -> BotDB:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def _read(self, name: str, *args, **kwargs):
+        return getattr(self._reader_db(), name)(*args, **kwargs)
+
+    def _write(self, name: str, *args, **kwargs):
+        return getattr(self._writer_db, name)(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        if name in self._READ_METHODS:
+            pool, func = self._readers, self._read
+        elif name in self._WRITE_METHODS:
+            pool, func = self._writer, self._write
+        else:
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            self.pending += 1
+            try:
+                with DB_SECONDS.time(name):
+                    return await loop.run_in_executor(pool, lambda: func(name, *args, **kwargs))
+            finally:
+                self.pending -= 1
+        method.__name__ = name
+        return method
+
+    def close(self):
+        _open_dbs.discard(self)
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            for i in self._dbs:
+                i.db.close()
+            self._dbs.clear()
+
+
+_shared: AsyncBotDB | None = None
+
+
+def get_shared_db() -> AsyncBotDB:
+    """コグの間で共有するAsyncBotDB
+
+    コグをリロードしても同じものを使い続けるので、閉じるのはBotを終了するときだけにする。
+    """
+    global _shared
+    if _shared is None:
+        _shared = AsyncBotDB.get_default_db()
+    return _shared
+
+
+def close_shared_db():
+    global _shared
+    if _shared is not None:
+        _shared.close()
+        _shared = None
+
+
+class RankingBuffer:
+    """rta_rankingへの書き込みをまとめて行うバッファ
+
+    記録の更新をメモリに溜め、1トランザクションで書き込む(グループコミット)。
+    ``wait_flushed`` は書き込み中でなければすぐに書き込みを始め、書き込み中なら
+    その間に溜まった分を次の書き込みでまとめて書く。終わるまで待つので、
+    ユーザーに返信する前にawaitすれば記録が消えることはない。
+    待っている人がいない分は、一定間隔でも書き込む。
+
+    Args:
+        db (AsyncBotDB): 書き込み先
+        interval (float): 待っている人がいない分を書き込む間隔(秒)
+    """
+    def __init__(self, db: AsyncBotDB, interval: float = 0.5) -> None:
+        self.db = db
+        self.interval = interval
+        self._dirty: dict[tuple[int, int], float] = {}
+        self._waiter: asyncio.Future | None = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._flushing: asyncio.Task | None = None
+
+    def submit(self, rta_id: int, user_id: int, time: float):
+        """更新された記録を書き込み待ちにする"""
+        old = self._dirty.get((rta_id, user_id))
+        if old is None or abs(time) < abs(old):
+            self._dirty[(rta_id, user_id)] = time
+
+    async def wait_flushed(self):
+        if not self._dirty:
+            return
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        waiter = self._waiter
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush_waiting())
+        await asyncio.shield(waiter)
+
+    async def _flush_waiting(self):
+        # 書き込み中に待ち始めた分も、続けて次の書き込みで書く
+        while self._waiter is not None:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("ランキングの書き込みに失敗しました。")
+                await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        async with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            waiter, self._waiter = self._waiter, None
+            if not dirty:
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+                return
+            rows = [(i, j, k) for (i, j), k in dirty.items()]
+            try:
+                await self.db.append_rankings(rows)
+            except Exception:
+                # 書き込めなかった分は次に回す
+                for i, j in dirty.items():
+                    self.submit(*i, j)
+                if waiter is not None:
+                    if self._waiter is not None:
+                        waiter.add_done_callback(_chain_future(self._waiter))
+                    self._waiter = waiter
+                raise
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._flushing is not None:
+            self._flushing.cancel()
+            self._flushing = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("ランキングの書き込みに失敗しました。")
+
+
+def _chain_future(target: asyncio.Future):
+    def callback(f: asyncio.Future):
+        if not target.done():
+            target.set_result(None)
+    return callback
 
 
 if __name__ == "__main__":
@@ -1,16 +1,74 @@
 from os import getenv
 import sys
+import time
 
 import discord
 import dotenv
+from discord import app_commands as ac
 from discord.ext import commands
 
 import db
+from utils import http, metrics
+from utils.cluster import parse_shard_ids
+from utils.sd_pool import QUEUE_DEPTH, pool
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", case_insensitive=True, intents=intents)
+COMMAND_SECONDS = metrics.registry.histogram(
+    "bot_command_seconds", "アプリコマンドの処理時間", ("command", "status")
+)
+COMMAND_ERRORS = metrics.registry.counter(
+    "bot_command_errors_total", "アプリコマンドのエラーの数", ("command", "error")
+)
+
+
+class Tree(ac.CommandTree):
+    """コマンドの処理時間とエラーを記録するCommandTree"""
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: ac.AppCommandError):
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        _observe_command(interaction, name, "error")
+        original = getattr(error, "original", error)
+        COMMAND_ERRORS.inc(name, type(original).__name__)
+        await super().on_error(interaction, error)
+
+
+def _observe_command(interaction: discord.Interaction, name: str, status: str):
+    started = interaction.extras.get("started")
+    if started is not None:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, name, status)
+
+
+class Bot(commands.AutoShardedBot):
+    async def close(self):
+        await super().close()
+        lag_monitor.stop()
+        await metrics_server.stop()
+        await http.client.close()
+        await pool.close()
+        db.close_shared_db()
+
+    def configure_shards(self):
+        """SHARD_COUNTとSHARD_IDSからこのプロセスのシャードを決める
+
+        どちらもなければDiscordの推奨の数のシャードを全部このプロセスで動かす。
+        複数のプロセスで分けるときは、同じSHARD_COUNTと別々のSHARD_IDS(``0-3`` など)を渡す。
+        """
+        count = getenv("SHARD_COUNT")
+        ids = getenv("SHARD_IDS")
+        if ids and not count:
+            raise ValueError("SHARD_IDSを指定するときはSHARD_COUNTも指定してください")
+        self.shard_count = int(count) if count else None
+        self.shard_ids = parse_shard_ids(ids) if ids else None
+
+
+bot = Bot(command_prefix="!", case_insensitive=True, intents=intents, tree_cls=Tree)
+lag_monitor = metrics.LoopLagMonitor()
+metrics_server = metrics.MetricsServer(metrics.registry)
 main_db = db.BotDB.get_default_db()
 
 
@@ -24,8 +82,20 @@ async def on_ready():
         print("Synced")
 
 
+@bot.event
+async def on_app_command_completion(
+    interaction: discord.Interaction, command: ac.Command | ac.ContextMenu
+):
+    _observe_command(interaction, command.qualified_name, "ok")
+
+
 @bot.event
 async def setup_hook():
+    lag_monitor.start()
+    metrics_server.port = int(getenv("METRICS_PORT", metrics_server.port))
+    await metrics_server.start()
+    # webuiの準備を待たずに起動する
+    pool.start()
     await bot.load_extension("cogs.common")
     await bot.load_extension("cogs.generate_image")
 
@@ -38,6 +108,7 @@ async def reload_all(ctx: discord.Interaction, sync: bool):
 
     await bot.reload_extension("cogs.common")
     await bot.reload_extension("cogs.generate_image")
+    pool.invalidate()
     embed = discord.Embed(
         title="Success*!*",
         description="リロードした",
@@ -48,8 +119,39 @@ async def reload_all(ctx: discord.Interaction, sync: bool):
         await bot.tree.sync()
 
 
+@bot.tree.command(name="stats", description="処理時間などの統計")
+async def stats(ctx: discord.Interaction):
+    if ctx.user.id != int(getenv("ADMIN_ID", 0)):
+        await ctx.response.send_message("You are not admin of this bot!!!!!!!!!")
+        return
+
+    metrics.registry.collect()
+    embed = discord.Embed(title="統計", color=discord.Colour.blue())
+    for title, histogram in (
+        ("コマンド", COMMAND_SECONDS), ("DB", db.DB_SECONDS), ("HTTP", metrics.HTTP_SECONDS)
+    ):
+        series = sorted(histogram.series().items(), key=lambda x: -x[1].count)[:10]
+        lines = [
+            f"`{'/'.join(k)}` {v.count}回 p50={v.p50 * 1000:.1f}ms p99={v.p99 * 1000:.1f}ms"
+            for k, v in series
+        ]
+        embed.add_field(name=title, value="\n".join(lines)[:1024] or "なし", inline=False)
+
+    lag = metrics.LOOP_LAG.series().get(())
+    if lag is not None:
+        embed.add_field(
+            name="イベントループの遅れ",
+            value=f"p50={lag.p50 * 1000:.1f}ms p99={lag.p99 * 1000:.1f}ms",
+        )
+    depth = [f"`{k[0]}` {v:g}" for k, v in QUEUE_DEPTH.series().items()]
+    depth.append(f"DB {db.DB_PENDING.series().get((), 0):g}")
+    embed.add_field(name="キュー", value="\n".join(depth)[:1024])
+    await ctx.response.send_message(embed=embed, ephemeral=True)
+
+
 if __name__ == "__main__":
     dotenv.load_dotenv()
+    bot.configure_shards()
     bot.run(getenv("APP_TOKEN", ""))
     main_db.db.close()
     print("closed")
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Callable
+
+import aiohttp
+import discord
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+ANNOUNCEMENTS = metrics.registry.counter(
+    "bot_announcements_total", "チャンネルへのお知らせの結果", ("result",)
+)
+ANNOUNCE_SECONDS = metrics.registry.histogram(
+    "bot_announcement_seconds", "お知らせを頼んでから送り終わるまでの時間", ("result",)
+)
+ANNOUNCE_PENDING = metrics.registry.gauge("bot_announcements_pending", "送る前のお知らせの数")
+
+
+class TokenBucket:
+    """per秒あたりrate回までに抑える
+
+    トークンを前借りできるようにして、足りない分だけ待つ。
+    待っている間に来た分はさらに後ろで待つので、呼ばれた順に通る。
+
+    Args:
+        rate (int): per秒あたりの回数
+        per (float): 秒数
+    """
+    def __init__(self, rate: int, per: float = 1.0) -> None:
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    def full(self) -> bool:
+        """使われていないときと同じ状態か"""
+        self._refill()
+        return self._tokens >= self.rate
+
+    def reserve(self) -> float:
+        """1回分を取って、使えるまでの秒数を返す"""
+        self._refill()
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens * self.per / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, (discord.Forbidden, discord.NotFound)):
+        return False
+    if isinstance(e, discord.HTTPException):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+class Announcer:
+    """RTAの開始/終了などのお知らせを、チャンネルごとに並行して送る
+
+    send()はすぐに返り、実際の送信はチャンネルごとのタスクで行う。
+    同じチャンネルの中では頼んだ順に送り、チャンネルごとと全体のTokenBucketで
+    Discordのレート制限に当たらないようにする。一時的な失敗はバックオフして
+    送り直し、チャンネルがない、権限がないときはそのお知らせだけ諦める。
+
+    Args:
+        resolve: チャンネルのIDから送り先を返す関数。なければNone
+        rate (int): 全体で1秒あたりに送る数
+        channel_rate (int): 1つのチャンネルにchannel_per秒あたりに送る数
+        channel_per (float): channel_rateの秒数
+        retries (int): 送り直す回数
+        backoff (float): 最初に送り直すまでの秒数。1回ごとに倍にする
+        timeout (float): 1回の送信を待つ秒数
+    """
+    def __init__(
+        self,
+        resolve: Callable[[int], Any],
+        rate: int = 40,
+        channel_rate: int = 5,
+        channel_per: float = 5.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        timeout: float = 15.0,
+    ) -> None:
+        self.resolve = resolve
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.channel_rate = channel_rate
+        self.channel_per = channel_per
+        self._global = TokenBucket(rate)
+        self._buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, deque[tuple[float, dict]]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._pending = 0
+        self._closed = False
+        metrics.registry.on_collect("announcer", lambda: ANNOUNCE_PENDING.set(self._pending))
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def send(self, channel_id: int, **kwargs):
+        """channel.send(**kwargs)を送る予定に入れる"""
+        if self._closed:
+            raise RuntimeError("Announcer is closed")
+        self._queues.setdefault(channel_id, deque()).append((time.perf_counter(), kwargs))
+        self._pending += 1
+        if channel_id not in self._workers:
+            if len(self._buckets) > 1024:
+                self._prune()
+            self._workers[channel_id] = asyncio.create_task(self._run(channel_id))
+
+    def _prune(self):
+        # 満タンに戻ったものは新しく作っても同じなので消す
+        for i in [k for k, v in self._buckets.items() if k not in self._workers and v.full()]:
+            del self._buckets[i]
+
+    async def join(self):
+        """頼まれた分を送り終わるまで待つ"""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def close(self, timeout: float = 10.0):
+        """新しく受け付けるのをやめ、残りを送るのをtimeout秒まで待つ"""
+        self._closed = True
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._pending}件のお知らせを送れないまま終了します。")
+            for i in self._workers.values():
+                i.cancel()
+
+    async def _run(self, channel_id: int):
+        queue = self._queues[channel_id]
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_per)
+        try:
+            while queue:
+                queued_at, kwargs = queue.popleft()
+                result = await self._deliver(channel_id, bucket, kwargs)
+                self._pending -= 1
+                ANNOUNCEMENTS.inc(result)
+                ANNOUNCE_SECONDS.observe(time.perf_counter() - queued_at, result)
+        finally:
+            # 送り終わったチャンネルのタスクとキューは残さない
+            del self._workers[channel_id]
+            del self._queues[channel_id]
+
+    async def _deliver(self, channel_id: int, bucket: TokenBucket, kwargs: dict) -> str:
+        channel = self.resolve(channel_id)
+        if channel is None:
+            logger.warning(f"チャンネル(id: {channel_id})が見つからないのでお知らせを送れませんでした。")
+            return "missing"
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                await asyncio.wait_for(channel.send(**kwargs), self.timeout)
+                return "sent"
+            except Exception as e:
+                if isinstance(e, discord.Forbidden):
+                    logger.warning(f"チャンネル(id: {channel_id})に送る権限がありません。")
+                    return "forbidden"
+                if isinstance(e, discord.NotFound):
+                    logger.warning(f"チャンネル(id: {channel_id})が見つかりませんでした。")
+                    return "missing"
+                if not _is_transient(e) or attempt == self.retries:
+                    logger.error(f"チャンネル(id: {channel_id})にお知らせを送れませんでした: {e!r}")
+                    return "failed"
+                delay = self.backoff * 2 ** attempt
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    delay = max(delay, retry_after)
+                # 同時に失敗したものが一斉に送り直さないようにずらす
+                await asyncio.sleep(delay * random.uniform(1, 1.5))
+        return "failed"
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# cluster_eventsのtargetで、リーダー宛てを表す
+LEADER = -1
+
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+    """Discordと同じ計算でサーバーを受け持つシャードを求める"""
+    return (guild_id >> 22) % shard_count
+
+
+def parse_shard_ids(value: str) -> list[int]:
+    """``0-3,8`` のような文字列をシャードのIDのリストにする"""
+    ids = []
+    for i in value.split(","):
+        i = i.strip()
+        if not i:
+            continue
+        if "-" in i:
+            start, end = i.split("-")
+            ids.extend(range(int(start), int(end) + 1))
+        else:
+            ids.append(int(i))
+    return ids
+
+
+def make_holder() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderElection:
+    """SQLiteのリースで、複数のプロセスのうち1つだけをリーダーにする
+
+    interval秒ごとにttl秒のリースを取るか延長する。延長できないままリースが
+    切れそうになったら、他のプロセスが取る前に自分からリーダーをやめる。
+
+    Args:
+        db (AsyncBotDB): リースを置くデータベース
+        name (str): リースの名前
+        on_change: リーダーになったときにTrue、やめたときにFalseで呼ばれる
+        ttl (float): リースの長さ(秒)
+        interval (float): 延長する間隔(秒)
+    """
+    def __init__(
+        self,
+        db,
+        name: str,
+        on_change: Callable[[bool], Awaitable[None]],
+        ttl: float = 15,
+        interval: float = 5,
+    ) -> None:
+        self.db = db
+        self.name = name
+        self.on_change = on_change
+        self.ttl = ttl
+        self.interval = interval
+        self.holder = make_holder()
+        self.is_leader = False
+        self._valid_until = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def assume(self):
+        """リースを使わずにリーダーになる。他にプロセスがいないとき用"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._set(True))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            await self._set(False)
+            # 正常に終わるときはすぐに他のプロセスが取れるようにする
+            try:
+                await self.db.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning(f"リースを返せませんでした: {e!r}")
+
+    async def _set(self, leader: bool):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        logger.info(f"{'リーダーになりました' if leader else 'リーダーをやめました'}: {self.name}")
+        try:
+            await self.on_change(leader)
+        except Exception:
+            logger.exception("リーダーの切り替えの処理に失敗しました")
+
+    async def _run(self):
+        while True:
+            s = time.monotonic()
+            try:
+                acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                logger.warning(f"リースを更新できませんでした: {e!r}")
+                # 延長できたかわからないので、切れる前にやめる
+                acquired = self.is_leader and time.monotonic() + self.interval < self._valid_until
+            else:
+                if acquired:
+                    self._valid_until = s + self.ttl
+            await self._set(acquired)
+            await asyncio.sleep(self.interval)
+
+
+class EventRelay:
+    """cluster_eventsを定期的に見て、このプロセス宛てのイベントを処理する
+
+    Args:
+        db (AsyncBotDB): イベントを置くデータベース
+        targets: 今受け取る宛先のリストを返す関数
+        handler: (event, rta_id)を受け取るコルーチン関数
+        interval (float): 見に行く間隔(秒)
+        max_age (float): これより古い(秒)イベントは受け取るプロセスがいないとみなして消す
+        prune_interval (float): 古いイベントを消す間隔(秒)
+    """
+    def __init__(
+        self,
+        db,
+        targets: Callable[[], list[int]],
+        handler: Callable[[str, int], Awaitable[None]],
+        interval: float = 0.5,
+        max_age: float = 600,
+        prune_interval: float = 60,
+    ) -> None:
+        self.db = db
+        self.targets = targets
+        self.handler = handler
+        self.interval = interval
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def post(self, target: int, event: str, rta_id: int):
+        await self.db.post_cluster_event(target, event, rta_id)
+
+    async def _run(self):
+        while True:
+            targets = self.targets()
+            rows = []
+            if targets:
+                try:
+                    rows = await self.db.take_cluster_events(targets)
+                except Exception as e:
+                    logger.warning(f"イベントを取得できませんでした: {e!r}")
+            for i in rows:
+                try:
+                    await self.handler(i["event"], i["rta_id"])
+                except Exception:
+                    logger.exception(f"イベント({i['event']}, RTA: {i['rta_id']})の処理に失敗しました")
+            if time.monotonic() - self._pruned_at >= self.prune_interval:
+                self._pruned_at = time.monotonic()
+                await self._prune()
+            await asyncio.sleep(self.interval)
+
+    async def _prune(self):
+        try:
+            removed = await self.db.prune_cluster_events(self.max_age)
+        except Exception as e:
+            logger.warning(f"古いイベントを消せませんでした: {e!r}")
+            return
+        if removed:
+            logger.warning(f"受け取られなかったイベントを{removed}件消しました")
+
+
+class RTACluster:
+    """RTAの処理を複数のプロセスに分ける
+
+    スケジューラはリーダーだけが動かす。開始や終了の通知はサーバーを受け持つ
+    シャードのプロセスで行い、リーダーが受け持っていなければcluster_eventsで渡す。
+    リーダー以外でRTAが追加されたときは、リーダーに渡してスケジューラに入れてもらう。
+
+    shard_idsがNoneなら1つのプロセスで全部のシャードを受け持っているとみなし、
+    リースを取らずにすぐリーダーになり、イベントの受け渡しもしない。
+
+    Args:
+        db (AsyncBotDB): データベース
+        shard_ids (list[int] | None): このプロセスのシャード
+        shard_count (int | None): 全体のシャードの数
+        on_leader: リーダーになったときにTrue、やめたときにFalseで呼ばれる
+        on_event: 渡された(event, rta_id)を処理するコルーチン関数
+        ttl (float): リースの長さ(秒)
+        interval (float): リースの延長の間隔(秒)
+        poll_interval (float): イベントを見に行く間隔(秒)
+    """
+    def __init__(
+        self,
+        db,
+        shard_ids: list[int] | None,
+        shard_count: int | None,
+        on_leader: Callable[[bool], Awaitable[None]],
+        on_event: Callable[[str, int], Awaitable[None]],
+        ttl: float = 15,
+        interval: float = 5,
+        poll_interval: float = 0.5,
+    ) -> None:
+        self.shard_ids = None if shard_ids is None or shard_count is None else set(shard_ids)
+        self.shard_count = shard_count
+        self.election = LeaderElection(db, "rta_scheduler", on_leader, ttl, interval)
+        self.relay = EventRelay(db, self._targets, on_event, poll_interval)
+
+    @property
+    def is_leader(self) -> bool:
+        return self.election.is_leader
+
+    def owns(self, guild_id: int) -> bool:
+        if self.shard_ids is None:
+            return True
+        assert self.shard_count is not None
+        return shard_for(guild_id, self.shard_count) in self.shard_ids
+
+    def start(self):
+        if self.shard_ids is None:
+            # 前に落ちたプロセスのリースが切れるのを待たない
+            self.election.assume()
+            return
+        self.election.start()
+        self.relay.start()
+
+    async def stop(self):
+        self.relay.stop()
+        await self.election.stop()
+
+    async def forward(self, event: str, guild_id: int, rta_id: int) -> bool:
+        """受け持っていないサーバーのイベントなら渡してTrueを返す"""
+        if self.owns(guild_id):
+            return False
+        assert self.shard_count is not None
+        await self.relay.post(shard_for(guild_id, self.shard_count), event, rta_id)
+        return True
+
+    async def to_leader(self, event: str, rta_id: int) -> bool:
+        """リーダーでなければリーダーに渡してTrueを返す
+
+        1つのプロセスのときは、まだリーダーになっていなくても自分で処理する。
+        リーダーになるときにDBから読み直すので取りこぼさない。
+        """
+        if self.is_leader or self.shard_ids is None:
+            return False
+        await self.relay.post(LEADER, event, rta_id)
+        return True
+
+    def _targets(self) -> list[int]:
+        targets = list(self.shard_ids or ())
+        if self.is_leader:
+            targets.append(LEADER)
+        return targets
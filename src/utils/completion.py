@@ -0,0 +1,104 @@
+import heapq
+import re
+from collections import OrderedDict
+from typing import Iterable
+
+# 単語の区切りとみなす文字
+SEPARATORS = frozenset(" -_.+()[]/")
+
+
+class CompletionEngine:
+    """オートコンプリート用の検索エンジン
+
+    前方一致 > 単語の先頭に一致 > 部分一致 > 飛び飛びに一致(subsequence)
+    の順に並べ、同じ順位の中では短い候補を先にする。
+    subsequenceの一致は詰まっているものから上位をヒープで取り出す。
+    入力が伸びたときは前回一致した候補だけを調べ直す。
+
+    Args:
+        items (Iterable[str]): 候補
+        cache_size (int): 覚えておくクエリの数
+    """
+    def __init__(self, items: Iterable[str], cache_size: int = 256) -> None:
+        self.items = list(items)
+        self._keys = [i.lower() for i in self.items]
+        self._set = set(self.items)
+        # 短い順に並べたインデックス。候補はいつもこの順で持つ
+        self._order = sorted(range(len(self.items)), key=lambda i: (len(self._keys[i]), i))
+        self._rank = [0] * len(self.items)
+        for rank, i in enumerate(self._order):
+            self._rank[i] = rank
+        self.cache_size = cache_size
+        # クエリ -> 一致した候補のインデックス
+        self._cache: OrderedDict[str, list[int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, item: str) -> bool:
+        return item in self._set
+
+    def search(self, text: str, limit: int = 25, exclude: str | None = None) -> list[str]:
+        query = text.lower()
+        if query == "":
+            return self._take([range(len(self.items))], limit, exclude)
+
+        keys = self._keys
+        prefix: list[int] = []
+        word: list[int] = []
+        substr: list[int] = []
+        fuzzy: list[tuple[int, int, int]] = []
+        matched: list[int] = []
+        pattern = re.compile(".*?".join(map(re.escape, query))) if len(query) > 1 else None
+        for i in self._candidates(query):
+            key = keys[i]
+            pos = key.find(query)
+            if pos == 0:
+                prefix.append(i)
+            elif pos > 0:
+                (word if key[pos - 1] in SEPARATORS else substr).append(i)
+            elif pattern is not None and (m := pattern.search(key)) is not None:
+                # 詰まって一致しているほど高い
+                fuzzy.append((m.end() - m.start(), self._rank[i], i))
+            else:
+                continue
+            matched.append(i)
+        self._remember(query, matched)
+
+        result = self._take([prefix, word, substr], limit, exclude)
+        if len(result) < limit:
+            if exclude is not None:
+                fuzzy = [i for i in fuzzy if exclude not in keys[i[2]]]
+            best = heapq.nsmallest(limit - len(result), fuzzy)
+            result.extend(self.items[i] for _, _, i in best)
+        return result
+
+    def _take(self, groups: list[Iterable[int]], limit: int, exclude: str | None) -> list[str]:
+        result = []
+        for group in groups:
+            for i in group:
+                if exclude is not None and exclude in self._keys[i]:
+                    continue
+                result.append(self.items[i])
+                if len(result) >= limit:
+                    return result
+        return result
+
+    def _candidates(self, query: str) -> Iterable[int]:
+        # どの一致の条件も、入力を伸ばすと一致する候補が減るだけなので
+        # 一番長い既知の接頭辞の結果から絞り込めばいい
+        for n in range(len(query) - 1, 0, -1):
+            hit = self._cache.get(query[:n])
+            if hit is not None:
+                self._cache.move_to_end(query[:n])
+                return hit
+        return self._order
+
+    def _remember(self, query: str, matched: list[int]):
+        self._cache[query] = matched
+        self._cache.move_to_end(query)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
@@ -0,0 +1,178 @@
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, TypeVar
+
+import aiohttp
+import yarl
+
+from utils import metrics
+
+IP_REGEX = r"^((25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])$"  # NOQA
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"  # NOQA
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class UnsafeURLError(Exception):
+    pass
+
+
+def is_safe_url(url: str | yarl.URL) -> bool:
+    """http(s)で、localhostやIPアドレスでないURLか"""
+    try:
+        parsed = yarl.URL(url)
+    except ValueError:
+        return False
+    return (
+        parsed.host is not None
+        and parsed.scheme in ("http", "https")
+        and parsed.host != "localhost"
+        and not re.match(IP_REGEX, parsed.host)
+    )
+
+
+def normalize_url(url: str | yarl.URL) -> str:
+    """キャッシュのキーにするためにURLを正規化する"""
+    parsed = yarl.URL(url).with_fragment(None)
+    if parsed.host is not None:
+        parsed = parsed.with_host(parsed.host.lower().rstrip("."))
+    if parsed.path == "":
+        parsed = parsed.with_path("/")
+    return str(parsed)
+
+
+class TTLCache(Generic[K, V]):
+    """有効期限付きのLRUキャッシュ
+
+    Args:
+        maxsize (int): 最大の件数
+        ttl (float): 有効期限(秒)
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 600) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: K, value: V):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+@dataclass(frozen=True)
+class RedirectChain:
+    """リダイレクトをたどった結果
+
+    Attributes:
+        history (list[str]): 最初のURLから最後のURLまで
+        status (int): 最後のレスポンスのステータスコード
+    """
+    history: list[str]
+    status: int
+
+
+class HTTPClient:
+    """Bot全体で使い回すHTTPクライアント
+
+    セッションは最初に使ったときに作られ、Botの終了時にcloseされる。
+
+    Args:
+        limit (int): 同時接続数の上限
+        limit_per_host (int): ホストごとの同時接続数の上限
+        timeout (float): 1リクエストのタイムアウト(秒)
+        dns_ttl (int): DNSのキャッシュの有効期限(秒)
+    """
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 8,
+        timeout: float = 10,
+        dns_ttl: int = 300,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self.redirects: TTLCache[str, RedirectChain] = TTLCache(maxsize=1024, ttl=600)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.dns_ttl,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": USER_AGENT},
+                trace_configs=[metrics.trace_config("http")],
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def resolve_redirects(
+        self,
+        url: str,
+        max_hops: int = 10,
+        validate: Callable[[yarl.URL], bool] = is_safe_url,
+    ) -> RedirectChain:
+        """リダイレクトを1つずつたどる
+
+        どのリダイレクト先もvalidateを通らなければUnsafeURLErrorを投げるので、
+        内部のホストにたどり着いた結果がキャッシュされることはない。
+        """
+        key = normalize_url(url)
+        cached = self.redirects.get(key)
+        if cached is not None:
+            return cached
+
+        current = yarl.URL(url)
+        history = [current]
+        for _ in range(max_hops + 1):
+            if not validate(current):
+                raise UnsafeURLError(str(current))
+            async with self.session.head(current, allow_redirects=False) as resp:
+                status = resp.status
+                location = resp.headers.get("Location")
+            if status not in (301, 302, 303, 307, 308) or location is None:
+                break
+            current = current.join(yarl.URL(location))
+            history.append(current)
+        else:
+            raise aiohttp.TooManyRedirects(None, ())  # type: ignore
+
+        chain = RedirectChain([str(i) for i in history], status)
+        self.redirects.set(key, chain)
+        return chain
+
+
+client = HTTPClient()
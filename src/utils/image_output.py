@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from io import BytesIO
+
+import discord
+from PIL import Image
+
+# ブーストしていないサーバーの添付ファイルの上限
+DEFAULT_SIZE_LIMIT = 25 * 1024 ** 2
+
+
+class ImageFormat(Enum):
+    ORIGINAL = "original"
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    ext: str
+
+    def to_file(self, name: str) -> discord.File:
+        # BytesIOは渡したbytesをコピーせずに使う
+        return discord.File(BytesIO(self.data), filename=f"{name}.{self.ext}")
+
+
+def sniff_ext(data: bytes) -> str | None:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _save(img: Image.Image, fmt: ImageFormat, quality: int) -> EncodedImage:
+    buf = BytesIO()
+    if fmt is ImageFormat.WEBP:
+        img.save(buf, format="webp", quality=quality, method=4)
+        return EncodedImage(buf.getvalue(), "webp")
+    if fmt is ImageFormat.JPEG:
+        img.convert("RGB").save(buf, format="jpeg", quality=quality, optimize=True)
+        return EncodedImage(buf.getvalue(), "jpg")
+    img.save(buf, format="png", optimize=True)
+    return EncodedImage(buf.getvalue(), "png")
+
+
+def encode(image: str | bytes, fmt: ImageFormat, limit: int = DEFAULT_SIZE_LIMIT) -> EncodedImage:
+    """画像を送れる形にする。CPUを使うのでexecutorで呼ぶこと
+
+    ORIGINALで上限に収まるならwebuiから来たデータをそのまま使う。
+    上限を超えるときは品質を下げたWebP、JPEGの順に試す。
+    """
+    data = base64.b64decode(image) if isinstance(image, str) else image
+    ext = sniff_ext(data)
+    if fmt is ImageFormat.ORIGINAL and ext is not None and len(data) <= limit:
+        return EncodedImage(data, ext)
+
+    img = Image.open(BytesIO(data))
+    if fmt is ImageFormat.ORIGINAL:
+        fmt = ImageFormat.PNG
+    attempts = [(fmt, 90)]
+    attempts += [(ImageFormat.WEBP, q) for q in (90, 75, 60)]
+    attempts += [(ImageFormat.JPEG, q) for q in (85, 70, 50)]
+    encoded = None
+    for f, q in attempts:
+        encoded = _save(img, f, q)
+        if len(encoded.data) <= limit:
+            break
+    assert encoded is not None
+    return encoded
+
+
+def make_grid(images: list[str | bytes], limit: int = DEFAULT_SIZE_LIMIT) -> EncodedImage:
+    """画像を並べた一覧(コンタクトシート)を作る。CPUを使うのでexecutorで呼ぶこと"""
+    imgs = [
+        Image.open(BytesIO(base64.b64decode(i) if isinstance(i, str) else i))
+        for i in images
+    ]
+    cols = math.ceil(math.sqrt(len(imgs)))
+    rows = math.ceil(len(imgs) / cols)
+    w = max(i.width for i in imgs)
+    h = max(i.height for i in imgs)
+    grid = Image.new("RGB", (w * cols, h * rows))
+    for n, img in enumerate(imgs):
+        grid.paste(img, ((n % cols) * w, (n // cols) * h))
+    # 一覧は大きくなるのでWebPにする
+    for q in (85, 70, 50):
+        encoded = _save(grid, ImageFormat.WEBP, q)
+        if len(encoded.data) <= limit:
+            break
+    return encoded
+
+
+class ImagePipeline:
+    """生成した画像をDiscordに送れる形にする
+
+    変換が要らなければそのまま通し、要るときはワーカーのスレッドで変換する。
+    (PillowはエンコードのあいだGILを手放す)
+
+    Args:
+        workers (int): 変換に使うスレッドの数
+    """
+    def __init__(self, workers: int = 2) -> None:
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="image-encode")
+
+    async def prepare_grid(
+        self, images: list[str | bytes], limit: int = DEFAULT_SIZE_LIMIT
+    ) -> EncodedImage:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, make_grid, images, limit)
+
+    async def prepare(
+        self, image: str | bytes, fmt: ImageFormat = ImageFormat.ORIGINAL,
+        limit: int = DEFAULT_SIZE_LIMIT,
+    ) -> EncodedImage:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, encode, image, fmt, limit)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,96 @@
+import bisect
+import itertools
+from typing import Iterable, Iterator
+
+# (|diff|, 記録した順番, user_id)。同じ差なら先に出した人が上
+_Key = tuple[float, int, int]
+
+
+class Leaderboard:
+    """1つのRTAの順位表
+
+    ユーザーごとの一番良い記録を差の絶対値の順に並べておく。
+    数百件ずつの整列済みのチャンクに分けて持つので、更新はチャンクの二分探索と
+    小さなリストへの挿入だけで済み、参加者が多くても全体を並べ直さない。
+
+    Args:
+        records (Iterable[tuple[int, float]]): 最初から入れておく(user_id, diff)
+        chunk_size (int): チャンクの大きさの目安
+    """
+    def __init__(self, records: Iterable[tuple[int, float]] = (), chunk_size: int = 512) -> None:
+        self.chunk_size = chunk_size
+        self._seq = itertools.count()
+        self._best: dict[int, float] = {}
+        self._keys: dict[int, _Key] = {}
+        self._chunks: list[list[_Key]] = []
+        # 各チャンクの最後(一番大きい)のキー
+        self._maxes: list[_Key] = []
+        for user_id, diff in records:
+            self.submit(user_id, diff)
+
+    def __len__(self) -> int:
+        return len(self._best)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._best
+
+    def __iter__(self) -> Iterator[tuple[int, float]]:
+        """(user_id, diff)を順位の順に返す"""
+        for chunk in self._chunks:
+            for _, _, user_id in chunk:
+                yield user_id, self._best[user_id]
+
+    def get(self, user_id: int) -> float | None:
+        return self._best.get(user_id)
+
+    def submit(self, user_id: int, diff: float) -> bool:
+        """記録を更新したらTrueを返す"""
+        old = self._best.get(user_id)
+        if old is not None:
+            if abs(old) <= abs(diff):
+                return False
+            self._remove(self._keys[user_id])
+        key = (abs(diff), next(self._seq), user_id)
+        self._best[user_id] = diff
+        self._keys[user_id] = key
+        self._insert(key)
+        return True
+
+    def top(self, n: int) -> list[tuple[int, float]]:
+        return list(itertools.islice(self, n))
+
+    def rank(self, user_id: int) -> int | None:
+        """1から始まる順位。記録がなければNone"""
+        key = self._keys.get(user_id)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self._maxes, key)
+        before = sum(len(j) for j in self._chunks[:i])
+        return before + bisect.bisect_left(self._chunks[i], key) + 1
+
+    def _insert(self, key: _Key):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        bisect.insort(chunk, key)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > self.chunk_size * 2:
+            # 大きくなりすぎたら半分に分ける
+            half = chunk[self.chunk_size:]
+            del chunk[self.chunk_size:]
+            self._chunks.insert(i + 1, half)
+            self._maxes[i] = chunk[-1]
+            self._maxes.insert(i + 1, half[-1])
+
+    def _remove(self, key: _Key):
+        i = bisect.bisect_left(self._maxes, key)
+        chunk = self._chunks[i]
+        del chunk[bisect.bisect_left(chunk, key)]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
@@ -0,0 +1,306 @@
+import asyncio
+import bisect
+import logging
+import time
+from types import SimpleNamespace
+from typing import Callable
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# 秒単位の区切り。コマンドやHTTPは数ms〜数十秒、DBは数十µs〜
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{i}="{_escape(j)}"' for i, j in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class _HistogramData:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """ラベルごとに値の分布を数える
+
+    値はイベントループのスレッドからだけ記録する。
+
+    Args:
+        name (str): メトリクスの名前
+        help (str): 説明
+        labels (tuple[str, ...]): ラベルの名前
+        buckets (tuple[float, ...]): 区切りの上限
+    """
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._data: dict[tuple[str, ...], _HistogramData] = {}
+
+    def observe(self, value: float, *labels: str):
+        data = self._data.get(labels)
+        if data is None:
+            data = self._data[labels] = _HistogramData(len(self.buckets) + 1)
+        data.counts[bisect.bisect_left(self.buckets, value)] += 1
+        data.sum += value
+        data.count += 1
+
+    def time(self, *labels: str) -> "_Timer":
+        """withの中の時間を記録する。最後のラベルには ok か error が入る"""
+        return _Timer(self, labels)
+
+    def series(self) -> dict[tuple[str, ...], SimpleNamespace]:
+        """ラベルごとの件数、合計、p50、p99"""
+        return {
+            k: SimpleNamespace(
+                count=v.count, sum=v.sum,
+                p50=self._quantile(v, 0.5), p99=self._quantile(v, 0.99),
+            )
+            for k, v in self._data.items()
+        }
+
+    def _quantile(self, data: _HistogramData, q: float) -> float:
+        """区切りの中で線形に補間した分位数"""
+        if data.count == 0:
+            return 0.0
+        rank = q * data.count
+        seen = 0
+        for i, count in enumerate(data.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = []
+        for labels, data in self._data.items():
+            total = 0
+            for bound, count in zip(self.buckets, data.counts):
+                total += count
+                le = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            le = _format_labels(self.labels, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {data.count}")
+            label = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label} {data.sum}")
+            lines.append(f"{self.name}_count{label} {data.count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple[str, ...]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        status = "ok" if exc_type is None else "error"
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels, status)
+
+
+class Counter:
+    """ラベルごとに回数を数える"""
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._data: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._data[labels] = self._data.get(labels, 0) + amount
+
+    def series(self) -> dict[tuple[str, ...], float]:
+        return dict(self._data)
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in self._data.items()
+        ]
+
+
+class Gauge(Counter):
+    """ラベルごとの今の値"""
+    type = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self._data[labels] = value
+
+    def clear(self):
+        self._data.clear()
+
+
+class Registry:
+    """メトリクスをまとめてPrometheusのテキスト形式で出力する
+
+    同じ名前で作ると既存のものを返すので、拡張を読み直しても二重にならない。
+    on_collectに登録した関数は出力の直前に呼ばれ、キューの長さなどのGaugeを更新する。
+    """
+    def __init__(self) -> None:
+        self._metrics: dict[str, Histogram | Counter] = {}
+        self._collectors: dict[str, Callable[[], None]] = {}
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), **kwargs) -> Histogram:
+        return self._get(Histogram, name, help, labels, **kwargs)
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def on_collect(self, name: str, func: Callable[[], None]):
+        """出力の前に呼ぶ関数を登録する。同じ名前なら置き換える"""
+        self._collectors[name] = func
+
+    def collect(self):
+        for name, func in self._collectors.items():
+            try:
+                func()
+            except Exception as e:
+                logger.warning(f"{name}の収集に失敗しました: {e!r}")
+
+    def render(self) -> str:
+        self.collect()
+        lines = []
+        for i in self._metrics.values():
+            lines.append(f"# HELP {i.name} {i.help}")
+            lines.append(f"# TYPE {i.name} {i.type}")
+            lines.extend(i.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+LOOP_LAG = registry.histogram("bot_event_loop_lag_seconds", "イベントループの遅れ")
+HTTP_SECONDS = registry.histogram(
+    "bot_http_request_seconds", "外へのHTTPリクエストの時間", ("client", "method", "status")
+)
+
+
+def trace_config(client: str) -> aiohttp.TraceConfig:
+    """aiohttpのセッションに渡すと、リクエストの時間をclientのラベルで記録する"""
+    config = aiohttp.TraceConfig()
+
+    async def on_start(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+        ctx.start = time.perf_counter()
+
+    async def on_end(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+        status = f"{params.response.status // 100}xx"
+        HTTP_SECONDS.observe(time.perf_counter() - ctx.start, client, params.method, status)
+
+    async def on_exception(
+        session, ctx: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams
+    ):
+        HTTP_SECONDS.observe(time.perf_counter() - ctx.start, client, params.method, "error")
+
+    config.on_request_start.append(on_start)
+    config.on_request_end.append(on_end)
+    config.on_request_exception.append(on_exception)
+    return config
+
+
+class LoopLagMonitor:
+    """一定間隔で眠り、予定より遅れて起きた時間をイベントループの遅れとして記録する
+
+    Args:
+        interval (float): 測る間隔(秒)
+    """
+    def __init__(self, interval: float = 0.5) -> None:
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            s = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(time.perf_counter() - s - self.interval, 0.0))
+
+
+class MetricsServer:
+    """``/metrics`` でメトリクスを返すHTTPサーバー
+
+    Args:
+        registry (Registry): 出力するメトリクス
+        host (str): 待ち受けるアドレス
+        port (int): 待ち受けるポート
+    """
+    def __init__(self, registry: Registry, host: str = "127.0.0.1", port: int = 9464) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logger.warning(f"メトリクスのサーバーを起動できませんでした: {e!r}")
+            await self.stop()
+            return
+        logger.info(f"メトリクスを http://{self.host}:{self.port}/metrics で公開しています")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def metrics(self, request: web.Request):
+        return web.Response(
+            text=self.registry.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
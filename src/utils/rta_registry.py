@@ -0,0 +1,75 @@
+import sqlite3
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from utils.leaderboard import Leaderboard
+
+
+@dataclass(eq=False)
+class ActiveRTA:
+    """開催中のRTA
+
+    Attributes:
+        row (sqlite3.Row): rta_dbの行
+        timestamp (float): 設定された時刻(UNIX時間)
+        board (Leaderboard): ユーザーごとの一番良い記録の順位表
+    """
+    row: sqlite3.Row
+    timestamp: float
+    board: Leaderboard = field(default_factory=Leaderboard)
+
+    @property
+    def id(self) -> int:
+        return self.row["id"]
+
+    @property
+    def channel_id(self) -> int:
+        return self.row["channel_id"]
+
+    @property
+    def guild_id(self) -> int:
+        return self.row["guild_id"]
+
+    def submit(self, user_id: int, diff: float) -> bool:
+        """記録を更新したらTrueを返す"""
+        return self.board.submit(user_id, diff)
+
+
+class ActiveRTARegistry:
+    """開催中のRTAをチャンネルごとに持っておく
+
+    on_messageからはDBを読まずにここだけを見る。
+    同じチャンネルで複数のRTAが重なっていてもいい。
+    """
+    def __init__(self) -> None:
+        self._by_id: dict[int, ActiveRTA] = {}
+        self._by_channel: dict[int, dict[int, ActiveRTA]] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, rta_id: int) -> bool:
+        return rta_id in self._by_id
+
+    def add(self, row: sqlite3.Row, ranking: Iterable[sqlite3.Row] = ()) -> ActiveRTA:
+        board = Leaderboard((i["user_id"], i["diff"]) for i in ranking)
+        rta = ActiveRTA(row, row["date"], board)
+        self._by_id[rta.id] = rta
+        self._by_channel.setdefault(rta.channel_id, {})[rta.id] = rta
+        return rta
+
+    def remove(self, rta_id: int) -> ActiveRTA | None:
+        rta = self._by_id.pop(rta_id, None)
+        if rta is None:
+            return None
+        channel = self._by_channel[rta.channel_id]
+        del channel[rta_id]
+        if not channel:
+            del self._by_channel[rta.channel_id]
+        return rta
+
+    def get(self, channel_id: int) -> list[ActiveRTA]:
+        channel = self._by_channel.get(channel_id)
+        if channel is None:
+            return []
+        return list(channel.values())
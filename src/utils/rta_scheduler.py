@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class RTAEventType(Enum):
+    START = "start"
+    END = "end"
+    # 繰り返しのRTAの次の回をrta_dbに追加する
+    EXPAND = "expand"
+
+
+@dataclass(order=True)
+class _Entry:
+    deadline: float
+    seq: int
+    type: RTAEventType = field(compare=False)
+    row: sqlite3.Row = field(compare=False)
+
+
+class RTAScheduler:
+    """RTAの開始/終了イベントを時刻順に発火させるスケジューラ
+
+    テーブルをポーリングする代わりに、ヒープに締め切り時刻を積んでおき
+    一番近いイベントの時刻まで眠る。
+
+    繰り返しのRTA(rta_schedule)は次の回の開始のlead秒前にEXPANDを発火させるだけで、
+    先の回の分はヒープに積まない。
+
+    Args:
+        callback: イベント発火時に呼ばれるコルーチン関数
+        margin (float): 設定時刻の何秒前に開始し、何秒後に終了するか
+        lead (float): 繰り返しのRTAを開始の何秒前に展開するか
+    """
+    def __init__(
+        self,
+        callback: Callable[[RTAEventType, sqlite3.Row], Awaitable[None]],
+        margin: float = 15,
+        lead: float = 60,
+    ) -> None:
+        self.callback = callback
+        self.margin = margin
+        self.lead = lead
+        self._heap: list[_Entry] = []
+        self._rows: dict[int, sqlite3.Row] = {}
+        self._schedules: dict[int, sqlite3.Row] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, rta_id: int) -> bool:
+        return rta_id in self._rows
+
+    def add(self, row: sqlite3.Row):
+        self._rows[row["id"]] = row
+        start = _Entry(row["date"] - self.margin, next(self._seq), RTAEventType.START, row)
+        end = _Entry(row["date"] + self.margin, next(self._seq), RTAEventType.END, row)
+        heapq.heappush(self._heap, start)
+        heapq.heappush(self._heap, end)
+        self._wakeup.set()
+
+    def add_schedule(self, row: sqlite3.Row):
+        self._schedules[row["id"]] = row
+        deadline = row["start_date"] - self.margin - self.lead
+        heapq.heappush(self._heap, _Entry(deadline, next(self._seq), RTAEventType.EXPAND, row))
+        self._wakeup.set()
+
+    def remove_schedule(self, schedule_id: int):
+        self._schedules.pop(schedule_id, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _pop_due(self, now: float) -> list[_Entry]:
+        due = []
+        while self._heap and self._heap[0].deadline <= now:
+            entry = heapq.heappop(self._heap)
+            rta_id = entry.row["id"]
+            if entry.type is RTAEventType.EXPAND:
+                if self._schedules.get(rta_id) is entry.row:
+                    del self._schedules[rta_id]
+                    due.append(entry)
+                continue
+            if self._rows.get(rta_id) is not entry.row:
+                continue  # 削除済みか、追加し直された
+            if entry.type is RTAEventType.START and now >= entry.row["date"] + self.margin:
+                continue  # 既に終了時刻を過ぎているので開始は飛ばす
+            if entry.type is RTAEventType.END:
+                del self._rows[rta_id]
+            due.append(entry)
+        return due
+
+    async def _run(self):
+        while True:
+            for entry in self._pop_due(time.time()):
+                try:
+                    await self.callback(entry.type, entry.row)
+                except Exception:
+                    logger.exception(f"RTA(id: {entry.row['id']})の処理に失敗しました。")
+
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = max(self._heap[0].deadline - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,155 @@
+import asyncio
+import datetime as dt
+import json
+import logging
+import time
+from dataclasses import dataclass
+
+import db
+from utils import http
+
+logger = logging.getLogger(__name__)
+
+URL = "https://school_schedule-1-u5735815.deta.app/"
+
+
+class ScheduleError(Exception):
+    pass
+
+
+@dataclass
+class ScheduleEntry:
+    """1日分の時程
+
+    Attributes:
+        date (datetime.date): 日付
+        data (dict | None): 時程。学校がない日(404)はNone
+        fetched_at (float): 取得した時刻(UNIX時間)
+    """
+    date: dt.date
+    data: dict | None
+    fetched_at: float
+
+    @property
+    def day(self) -> int:
+        return self.date.day
+
+    @property
+    def status(self) -> int:
+        return 404 if self.data is None else 200
+
+
+class ScheduleCache:
+    """時程のキャッシュ
+
+    キャッシュがあればすぐに返し、古ければ裏で取り直す(stale-while-revalidate)。
+    学校がない日(404)も覚えておく。内容はSQLiteにも保存するので再起動後もそのまま使える。
+    APIは日にちしか受け取らないが、月をまたいで別の日の分を返さないように日付ごとに持つ。
+
+    Args:
+        db (AsyncBotDB): 保存先
+        url (str): 時程のAPI
+        ttl (float): この秒数より古ければ取り直す
+        prefetch_days (int): 何日先まで先に取得しておくか
+        prefetch_interval (float): 先読みの間隔(秒)
+    """
+    def __init__(
+        self,
+        db: db.AsyncBotDB,
+        url: str = URL,
+        ttl: float = 3600,
+        prefetch_days: int = 3,
+        prefetch_interval: float = 3600,
+    ) -> None:
+        self.db = db
+        self.url = url
+        self.ttl = ttl
+        self.prefetch_days = prefetch_days
+        self.prefetch_interval = prefetch_interval
+        self._entries: dict[dt.date, ScheduleEntry] = {}
+        self._fetching: dict[dt.date, asyncio.Task] = {}
+        self._task: asyncio.Task | None = None
+
+    async def load(self):
+        for i in await self.db.get_school_schedules(dt.date.today()):
+            data = json.loads(i["body"]) if i["status"] == 200 else None
+            day = dt.date.fromisoformat(i["date"])
+            self._entries[day] = ScheduleEntry(day, data, i["fetched_at"])
+        logger.info(f"{len(self._entries)}日分の時程を読み込みました。")
+
+    def get_cached(self, day: dt.date) -> ScheduleEntry | None:
+        entry = self._entries.get(day)
+        if entry is not None and self._is_stale(entry):
+            self._refresh_in_background(day)
+        return entry
+
+    async def get(self, day: dt.date) -> ScheduleEntry:
+        entry = self.get_cached(day)
+        if entry is None:
+            entry = await self.refresh(day)
+        return entry
+
+    async def refresh(self, day: dt.date) -> ScheduleEntry:
+        # 同じ日を同時に取りに行かない
+        task = self._fetching.get(day)
+        if task is None or task.done():
+            task = self._fetching[day] = asyncio.create_task(self._fetch(day))
+        return await asyncio.shield(task)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._prefetch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _is_stale(self, entry: ScheduleEntry) -> bool:
+        return time.time() - entry.fetched_at > self.ttl
+
+    def _refresh_in_background(self, day: dt.date):
+        task = self._fetching.get(day)
+        if task is not None and not task.done():
+            return
+        task = self._fetching[day] = asyncio.create_task(self._fetch(day))
+        task.add_done_callback(_log_error)
+
+    async def _fetch(self, day: dt.date) -> ScheduleEntry:
+        async with http.client.session.get(self.url, params={"day": day.day}) as resp:
+            if resp.status == 404:
+                entry = ScheduleEntry(day, None, time.time())
+            elif resp.status == 200:
+                entry = ScheduleEntry(day, await resp.json(), time.time())
+            else:
+                raise ScheduleError(f"status {resp.status}")
+        self._entries[day] = entry
+        body = json.dumps(entry.data) if entry.data is not None else None
+        await self.db.set_school_schedule(day, entry.status, body, entry.fetched_at)
+        return entry
+
+    async def _prefetch(self):
+        while True:
+            today = dt.date.today()
+            # 過ぎた日の分は使わないので消す
+            for i in [i for i in self._entries if i < today]:
+                del self._entries[i]
+            try:
+                await self.db.delete_school_schedules(today)
+            except Exception:
+                logger.warning("古い時程を消せませんでした", exc_info=True)
+            for i in range(self.prefetch_days + 1):
+                day = today + dt.timedelta(days=i)
+                entry = self._entries.get(day)
+                if entry is not None and not self._is_stale(entry):
+                    continue
+                try:
+                    await self.refresh(day)
+                except Exception as e:
+                    logger.warning(f"{day}の時程の先読みに失敗しました: {e!r}")
+            await asyncio.sleep(self.prefetch_interval)
+
+
+def _log_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("時程の更新に失敗しました", exc_info=task.exception())
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+from utils import metrics
+from utils.stable_diffusion import GenerationResult, Options
+
+logger = logging.getLogger(__name__)
+
+CACHE_REQUESTS = metrics.registry.counter(
+    "bot_sd_cache_requests_total", "生成結果のキャッシュを引いた回数", ("result",)
+)
+CACHE_BYTES = metrics.registry.gauge("bot_sd_cache_bytes", "生成結果のキャッシュの大きさ")
+
+
+def cache_key(options: Options, params: dict) -> str | None:
+    """実際にwebuiに送るオプションとパラメータのハッシュ。seedが-1なら毎回違うのでNone"""
+    if params.get("seed", -1) == -1:
+        return None
+    canonical = json.dumps(
+        {"model": options.model, "vae": options.vae, "params": params},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """seedを固定した生成結果をディスクに置いておくキャッシュ
+
+    ファイル名はパラメータのハッシュなので、同じ条件なら同じファイルになる。
+    どのキーがあるかと大きさはメモリに持っておき、ないときはディスクを見ずに外れを返す。
+    合計がmax_bytesを超えたら最後に使われたのが古いものから消す。
+
+    索引はプロセスごとに持つので、複数のプロセスで同じ置き場所を使うと
+    上限もプロセスごとになる(全体ではプロセス数×max_bytesまで増えうる)。
+    他のプロセスが消したファイルは、読めなかったときに索引から外す。
+
+    Args:
+        directory (Path): 置き場所
+        max_bytes (int): 合計の大きさの上限
+    """
+    def __init__(self, directory: Path, max_bytes: int = 512 * 1024 ** 2) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._loaded = False
+        metrics.registry.on_collect("sd_cache", lambda: CACHE_BYTES.set(self._size))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    async def load(self):
+        """ディスクにあるものを、最後に使われた順に索引に入れる"""
+        if self._loaded:
+            return
+        self._loaded = True
+        entries = await asyncio.to_thread(self._scan)
+        for key, size in entries:
+            self._index[key] = size
+            self._size += size
+        logger.info(f"生成結果のキャッシュを{len(entries)}件読み込みました。")
+        await self._evict()
+
+    def _scan(self) -> list[tuple[str, int]]:
+        if not self.directory.exists():
+            return []
+        entries = []
+        for i in self.directory.glob("*/*.json"):
+            stat = i.stat()
+            entries.append((stat.st_mtime, i.stem, stat.st_size))
+        entries.sort()
+        return [(key, size) for _, key, size in entries]
+
+    async def get(self, key: str) -> GenerationResult | None:
+        if key not in self._index:
+            self.misses += 1
+            CACHE_REQUESTS.inc("miss")
+            return None
+        self._index.move_to_end(key)
+        try:
+            data = await asyncio.to_thread(self._read, self._path(key))
+        except (OSError, ValueError) as e:
+            logger.warning(f"キャッシュを読めませんでした: {e!r}")
+            self._forget(key)
+            self.misses += 1
+            CACHE_REQUESTS.inc("miss")
+            return None
+        self.hits += 1
+        CACHE_REQUESTS.inc("hit")
+        return GenerationResult(**data)
+
+    @staticmethod
+    def _read(path: Path) -> dict:
+        data = json.loads(path.read_bytes())
+        # 最後に使った時刻として再起動後の順番に使う
+        os.utime(path)
+        return data
+
+    async def put(self, key: str, result: GenerationResult):
+        data = json.dumps(
+            {"images": result.images, "info": result.info, "parameters": result.parameters},
+            ensure_ascii=False,
+        ).encode()
+        if len(data) > self.max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write, self._path(key), data)
+        except OSError as e:
+            logger.warning(f"キャッシュに書き込めませんでした: {e!r}")
+            return
+        self._forget(key)
+        self._index[key] = len(data)
+        self._size += len(data)
+        await self._evict()
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 同じキーを同時に書いても混ざらないように、一時ファイルは毎回別の名前にする
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            f.write(data)
+        try:
+            # 書きかけのファイルを読まないように置き換える
+            os.replace(f.name, path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    async def _evict(self):
+        removed = []
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            removed.append(self._path(key))
+        if removed:
+            await asyncio.to_thread(self._unlink, removed)
+
+    @staticmethod
+    def _unlink(paths: list[Path]):
+        for i in paths:
+            i.unlink(missing_ok=True)
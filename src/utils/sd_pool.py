@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from os import getenv
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from utils import metrics
+from utils.sd_queue import GenerationQueue, Job, QueueFullError
+from utils.stable_diffusion import (
+    PORT, BackendState, GenerationResult, ModelCatalog, ModelsAPI, Options, SDBackend
+)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.registry.gauge(
+    "bot_sd_queue_depth", "webuiごとの待っているジョブと処理中のジョブの数", ("backend",)
+)
+
+
+class NoBackendError(Exception):
+    pass
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """続けて失敗したwebuiにしばらくリクエストを送らないようにする
+
+    threshold回続けて失敗したら開き、reset_timeout秒たったら1件だけ試す。
+    それが成功したら閉じ、失敗したらまた開く。
+
+    Args:
+        threshold (int): 何回続けて失敗したら開くか
+        reset_timeout (float): 開いてから試すまでの秒数
+    """
+    def __init__(self, threshold: int = 3, reset_timeout: float = 30) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._trial = False
+
+    @property
+    def state(self) -> BreakerState:
+        if self._opened_at is None:
+            return BreakerState.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return BreakerState.HALF_OPEN
+        return BreakerState.OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state is BreakerState.HALF_OPEN:
+            return not self._trial
+        return state is BreakerState.CLOSED
+
+    def acquire(self):
+        """リクエストを送る直前に呼ぶ。半開きなら試しの1件として数える"""
+        if self.state is BreakerState.HALF_OPEN:
+            self._trial = True
+
+    def release(self):
+        """acquireしたのにリクエストを送らなかったときに、試しの枠を返す"""
+        self._trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+        self._trial = False
+
+
+@dataclass(eq=False)
+class PoolMember:
+    """プールの中の1台のwebui"""
+    backend: SDBackend
+    queue: GenerationQueue
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+
+    @property
+    def api(self) -> ModelsAPI:
+        return self.backend.api
+
+    @property
+    def available(self) -> bool:
+        return self.backend.ready and self.breaker.allow()
+
+    @property
+    def load(self) -> int:
+        """このwebuiで待っているジョブの数"""
+        load = len(self.queue) + self.queue.inflight
+        if self.queue.inflight == 0:
+            # 他のクライアントが使っている分
+            load += self.backend.remote_jobs
+        return load
+
+    def has_model(self, model: str) -> bool:
+        models = self.backend.catalog.models.peek()
+        # まだ一覧がなければ、あるものとして扱う
+        return models is None or model in models
+
+
+def parse_endpoints(value: str) -> list[ModelsAPI]:
+    """``127.0.0.1:7861,https://gpu2:443`` のようなカンマ区切りの文字列からAPIを作る"""
+    apis = []
+    for i in value.split(","):
+        i = i.strip()
+        if not i:
+            continue
+        if "://" not in i:
+            i = "http://" + i
+        url = urlsplit(i)
+        apis.append(ModelsAPI(
+            host=url.hostname or "127.0.0.1",
+            port=url.port or PORT,
+            use_https=url.scheme == "https",
+        ))
+    return apis
+
+
+def _is_backend_error(e: BaseException) -> bool:
+    """webui側の問題で、他のwebuiでやり直せばよいエラーか"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+
+class BackendPool:
+    """複数のwebuiに生成を振り分ける
+
+    webuiごとにSDBackendで状態を確認し、GenerationQueueで生成を並べる。
+    ジョブは待ちの少ないwebuiに送るが、そのモデルを読み込み済みのwebuiは
+    affinity_penalty件分だけ優先する。webuiの障害で失敗したジョブは
+    別のwebuiでretries回までやり直し、続けて失敗したwebuiはCircuitBreakerで外す。
+
+    webuiを渡さなければ、startしたときに環境変数 ``SD_BACKENDS`` から読む。
+
+    Args:
+        apis (list[ModelsAPI] | None): webuiのAPIのリスト
+        retries (int): 別のwebuiでやり直す回数
+        affinity_penalty (int): モデルの切り替えを何件分の待ちとみなすか
+        max_per_user (int): 1人が同時に入れられるジョブの数
+    """
+    def __init__(
+        self,
+        apis: list[ModelsAPI] | None = None,
+        retries: int = 2,
+        affinity_penalty: int = 2,
+        max_per_user: int = 3,
+    ) -> None:
+        self.retries = retries
+        self.affinity_penalty = affinity_penalty
+        self.max_per_user = max_per_user
+        self.members: list[PoolMember] = []
+        # 全部のwebuiの一覧を合わせたもの
+        self.catalog = ModelCatalog(self)
+        self._routes: dict[Job, tuple[PoolMember, Job]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        metrics.registry.on_collect("sd_pool", self._collect)
+        if apis:
+            self.configure(apis)
+
+    def configure(self, apis: list[ModelsAPI]):
+        self.members = [
+            PoolMember(SDBackend(i), GenerationQueue(i, max_per_user=self.max_per_user))
+            for i in apis
+        ]
+
+    @property
+    def state(self) -> BackendState:
+        states = {i.backend.state for i in self.members}
+        if BackendState.READY in states:
+            return BackendState.READY
+        if BackendState.WARMING_UP in states or not states:
+            return BackendState.WARMING_UP
+        return BackendState.DOWN
+
+    @property
+    def ready(self) -> bool:
+        return self.state is BackendState.READY
+
+    def start(self):
+        if not self.members:
+            self.configure(parse_endpoints(getenv("SD_BACKENDS", f"127.0.0.1:{PORT}")))
+        for i in self.members:
+            i.backend.start()
+
+    def invalidate(self):
+        """全体の一覧と、振り分けに使うwebuiごとの一覧を取り直させる"""
+        self.catalog.invalidate()
+        for i in self.members:
+            i.backend.catalog.invalidate()
+
+    async def close_queues(self):
+        """待っているジョブを全部キャンセルする"""
+        for i in self._tasks:
+            i.cancel()
+        for i in self.members:
+            await i.queue.close()
+
+    async def close(self):
+        await self.close_queues()
+        for i in self.members:
+            await i.backend.close()
+
+    def pick(self, options: Options, exclude: set[PoolMember] | None = None) -> PoolMember | None:
+        """ジョブを送るwebuiを選ぶ。使えるものがなければNone"""
+        candidates = [
+            i for i in self.members
+            if i.available and (not exclude or i not in exclude) and i.has_model(options.model)
+        ]
+        if not candidates:
+            return None
+
+        def cost(member: PoolMember) -> tuple[int, int]:
+            affinity = member.api.current == options
+            return (member.load + (0 if affinity else self.affinity_penalty), not affinity)
+        return min(candidates, key=cost)
+
+    def submit(self, user_id: int, options: Options, params: dict) -> Job:
+        if sum(1 for i in self._routes if i.user_id == user_id) >= self.max_per_user:
+            raise QueueFullError(f"user {user_id} has too many jobs")
+        loop = asyncio.get_running_loop()
+        job = Job(user_id, options, params, loop.create_future())
+        member = self.pick(options)
+        if member is None:
+            raise NoBackendError("no backend available")
+        self._route(job, member)
+        task = asyncio.create_task(self._dispatch(job, member))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def position(self, job: Job) -> int:
+        """このジョブの前に処理される予定のジョブの数。処理中なら0"""
+        route = self._routes.get(job)
+        if route is None:
+            return 0
+        member, inner = route
+        return member.queue.position(inner)
+
+    def _route(self, job: Job, member: PoolMember):
+        member.breaker.acquire()
+        try:
+            inner = member.queue.submit(job.user_id, job.options, job.params)
+        except BaseException:
+            member.breaker.release()
+            raise
+        self._routes[job] = (member, inner)
+
+    async def _dispatch(self, job: Job, member: PoolMember):
+        tried = {member}
+        try:
+            while True:
+                _, inner = self._routes[job]
+                await inner.started.wait()
+                job.api = inner.api
+                job.started.set()
+                try:
+                    result: GenerationResult = await inner
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if not _is_backend_error(e):
+                        # 4xxなどはwebuiが応答しているので成功として扱い、試しの枠も返す
+                        member.breaker.record_success()
+                        job.future.set_exception(e)
+                        return
+                    member.breaker.record_failure()
+                    logger.warning(f"{member.api.base_url}での生成に失敗しました: {e!r}")
+                    next_member = None
+                    if len(tried) <= self.retries:
+                        next_member = self.pick(job.options, exclude=tried)
+                    if next_member is None:
+                        job.future.set_exception(e)
+                        return
+                    tried.add(next_member)
+                    try:
+                        self._route(job, next_member)
+                    except Exception as reroute_error:
+                        logger.warning(
+                            f"{next_member.api.base_url}でやり直せませんでした: {reroute_error!r}"
+                        )
+                        job.future.set_exception(e)
+                        return
+                    member = next_member
+                else:
+                    member.breaker.record_success()
+                    job.future.set_result(result)
+                    return
+        except asyncio.CancelledError:
+            # 結果がわからないまま終わるので、試しの枠だけ返す
+            member.breaker.release()
+            job.future.cancel()
+            raise
+        finally:
+            job.started.set()
+            del self._routes[job]
+
+    def _collect(self):
+        QUEUE_DEPTH.clear()
+        for i in self.members:
+            QUEUE_DEPTH.set(len(i.queue) + i.queue.inflight, i.api.base_url)
+
+    async def _gather(self, name: str) -> list[str]:
+        members = [i for i in self.members if i.available]
+        if not members:
+            raise NoBackendError("no backend available")
+        results = await asyncio.gather(
+            *(getattr(i.api, name)() for i in members), return_exceptions=True
+        )
+        lists = [i for i in results if not isinstance(i, BaseException)]
+        if not lists:
+            error = results[0]
+            assert isinstance(error, BaseException)
+            raise error
+        # 順番を保ったまま重複を除く
+        return list(dict.fromkeys(j for i in lists for j in i))
+
+    async def get_models(self) -> list[str]:
+        return await self._gather("get_models")
+
+    async def get_vaes(self) -> list[str]:
+        return await self._gather("get_vaes")
+
+    async def get_embeddings(self) -> list[str]:
+        return await self._gather("get_embeddings")
+
+
+pool = BackendPool()
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from utils.sd_queue import Job
+from utils.stable_diffusion import Progress
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressReporter:
+    """生成中の進捗をwebuiから取得して通知する
+
+    ``async with`` の間だけ取得を続ける。取得はpoll_intervalごとだが、
+    通知(メッセージの編集)は最新のものだけをmin_intervalに1回までにまとめる。
+
+    Args:
+        job (Job): 進捗を取得するジョブ。処理しているwebuiに問い合わせる
+        update: 進捗を受け取るコルーチン関数
+        preview (bool): 途中経過の画像も取得するか
+        poll_interval (float): 取得の間隔(秒)
+        min_interval (float): 通知の最短の間隔(秒)
+    """
+    def __init__(
+        self,
+        job: Job,
+        update: Callable[[Progress], Awaitable[None]],
+        preview: bool = False,
+        poll_interval: float = 1.0,
+        min_interval: float = 3.0,
+    ) -> None:
+        self.job = job
+        self.update = update
+        self.preview = preview
+        self.poll_interval = poll_interval
+        self.min_interval = min_interval
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *args):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        last_sent = time.monotonic()
+        last_percent = -1
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.job.api is None or time.monotonic() - last_sent < self.min_interval:
+                continue
+            try:
+                progress = await self.job.api.get_progress(skip_current_image=not self.preview)
+            except Exception as e:
+                logger.debug(f"進捗の取得に失敗しました: {e!r}")
+                continue
+            percent = int(progress.progress * 100)
+            if percent == last_percent:
+                continue
+            last_percent = percent
+            last_sent = time.monotonic()
+            try:
+                await self.update(progress)
+            except Exception as e:
+                logger.debug(f"進捗の通知に失敗しました: {e!r}")
@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import logging
+from dataclasses import dataclass, field
+
+from utils.stable_diffusion import GenerationResult, ModelsAPI, Options
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+@dataclass(eq=False)
+class Job:
+    """キューに入った生成リクエスト"""
+    user_id: int
+    options: Options
+    params: dict
+    future: asyncio.Future = field(repr=False)
+    seq: int = 0
+    skipped: int = 0
+    started: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    # 処理を始めたwebui。進捗の取得に使う
+    api: ModelsAPI | None = field(default=None, repr=False)
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return (self.options.model, self.options.vae)
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class GenerationQueue:
+    """webuiへの生成リクエストを並べるキュー
+
+    同じ(モデル, VAE)のジョブをまとめて流し、チェックポイントの切り替えを減らす。
+    ただし、後回しにされた回数がmax_skipsに達したジョブは優先し、
+    同じ条件なら最近処理されていないユーザーを先にする。
+
+    Args:
+        api (ModelsAPI): 生成に使うAPI
+        max_inflight (int): 同時にwebuiに投げるジョブの数
+        max_per_user (int): 1人が同時にキューに入れられるジョブの数
+        max_skips (int): 何回後回しにされたら優先するか
+    """
+    def __init__(
+        self,
+        api: ModelsAPI,
+        max_inflight: int = 1,
+        max_per_user: int = 3,
+        max_skips: int = 4,
+    ) -> None:
+        self.api = api
+        self.max_inflight = max_inflight
+        self.max_per_user = max_per_user
+        self.max_skips = max_skips
+        self._pending: list[Job] = []
+        self._served: dict[int, int] = {}
+        self._inflight = 0
+        self._seq = itertools.count()
+        self._cond: asyncio.Condition | None = None
+        self._task: asyncio.Task | None = None
+        # 参照を持っておかないと実行中にGCされることがある
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def submit(self, user_id: int, options: Options, params: dict) -> Job:
+        if sum(1 for i in self._pending if i.user_id == user_id) >= self.max_per_user:
+            raise QueueFullError(f"user {user_id} has too many jobs")
+        loop = asyncio.get_running_loop()
+        job = Job(user_id, options, params, loop.create_future(), next(self._seq))
+        self._pending.append(job)
+        self._start()
+        self._notify()
+        return job
+
+    def position(self, job: Job) -> int:
+        """このジョブの前に処理される予定のジョブの数。処理中なら0"""
+        if job not in self._pending:
+            return 0
+        pending = list(self._pending)
+        skipped = {i: i.skipped for i in pending}
+        served = dict(self._served)
+        current = self._current_key()
+        count = self._inflight
+        while pending:
+            picked = self._pick(pending, skipped, served, current)
+            if picked is job:
+                return count
+            self._advance(pending, picked, skipped, served)
+            current = picked.key
+            count += 1
+        return count
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for i in self._tasks:
+            i.cancel()
+        for i in self._pending:
+            i.future.cancel()
+            i.started.set()
+        self._pending.clear()
+
+    def _pick(
+        self,
+        pending: list[Job],
+        skipped: dict[Job, int],
+        served: dict[int, int],
+        current: tuple[str, str] | None,
+    ) -> Job:
+        for i in pending:
+            if skipped[i] >= self.max_skips:
+                return i
+        candidates = [i for i in pending if i.key == current] or pending
+        return min(candidates, key=lambda i: (served.get(i.user_id, -1), i.seq))
+
+    def _advance(
+        self,
+        pending: list[Job],
+        picked: Job,
+        skipped: dict[Job, int],
+        served: dict[int, int],
+    ):
+        for i in pending:
+            if i is picked:
+                break
+            skipped[i] += 1
+        pending.remove(picked)
+        served[picked.user_id] = max(served.values(), default=0) + 1
+
+    def _notify(self):
+        if self._cond is None:
+            return
+
+        async def notify(cond: asyncio.Condition):
+            async with cond:
+                cond.notify_all()
+        self._spawn(notify(self._cond))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._cond = asyncio.Condition()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        assert self._cond is not None
+        cond = self._cond
+        while True:
+            async with cond:
+                await cond.wait_for(
+                    lambda: self._pending and self._inflight < self.max_inflight
+                )
+                skipped = {i: i.skipped for i in self._pending}
+                job = self._pick(self._pending, skipped, self._served, self._current_key())
+                self._advance(self._pending, job, skipped, self._served)
+                for i, j in skipped.items():
+                    i.skipped = j
+
+                if job.key != self._current_key():
+                    # 切り替える前に処理中のジョブを終わらせる
+                    await cond.wait_for(lambda: self._inflight == 0)
+                    try:
+                        await self.api.ensure_options(job.options)
+                    except Exception as e:
+                        job.started.set()
+                        job.future.set_exception(e)
+                        continue
+                self._inflight += 1
+            job.api = self.api
+            job.started.set()
+            self._spawn(self._execute(job))
+
+    def _current_key(self) -> tuple[str, str] | None:
+        current = self.api.current
+        if current is None:
+            return None
+        return (current.model, current.vae)
+
+    async def _execute(self, job: Job):
+        assert self._cond is not None
+        try:
+            result: GenerationResult = await self.api.txt2img(**job.params)
+        except Exception as e:
+            # webuiが再起動したかもしれないので、次の切り替え前に取り直す
+            self.api.invalidate_options()
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            async with self._cond:
+                self._inflight -= 1
+                self._cond.notify_all()
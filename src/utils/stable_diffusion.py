@@ -1,9 +1,26 @@
+import asyncio
+import json
+import logging
+import time
 from dataclasses import dataclass
 from enum import Enum
+from typing import Awaitable, Callable, Protocol
 
-import webuiapi
+import aiohttp
 from discord import app_commands as ac
 
+from utils import metrics
+from utils.completion import CompletionEngine
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SWITCHES = metrics.registry.counter(
+    "bot_sd_checkpoint_switches_total", "webuiごとのモデルを切り替えた回数", ("backend",)
+)
+CHECKPOINT_SWITCH_SECONDS = metrics.registry.histogram(
+    "bot_sd_checkpoint_switch_seconds", "webuiごとのモデルの切り替えにかかった時間", ("backend",)
+)
+
 
 # stable-diffusion-webui V1.7.0のサンプラー
 class Samplers(Enum):
@@ -67,29 +84,348 @@ class Defaults:
         )
 
 
+@dataclass
+class GenerationResult:
+    """txt2imgの結果
+
+    Attributes:
+        images (list[str]): base64でエンコードされた画像
+        info (dict): 生成情報(seedやモデル名など)
+        parameters (dict): 送ったパラメータ
+    """
+    images: list[str]
+    info: dict
+    parameters: dict
+
+
+@dataclass
+class Progress:
+    """生成の進捗
+
+    Attributes:
+        progress (float): 0から1
+        eta (float): 残り時間(秒)
+        image (str | None): base64の途中経過の画像
+        job_count (int): webuiで処理中のジョブの数
+    """
+    progress: float
+    eta: float
+    image: str | None = None
+    job_count: int = 0
+
+
 class ModelsAPI:
-    """オプションの設定や取得"""
-    def __init__(self, api: webuiapi.WebUIApi) -> None:
-        self.api = api
+    """webuiのAPIクライアント。オプションの設定や取得、生成
+
+    1つのaiohttpのセッションを使い回す。セッションは最初に使ったときに作られる。
+
+    Args:
+        host (str): webuiのホスト
+        port (int): webuiのポート
+        use_https (bool): httpsを使うか
+        limit (int): 同時接続数の上限
+    """
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 7861,
+        use_https: bool = False,
+        limit: int = 8,
+    ) -> None:
+        scheme = "https" if use_https else "http"
+        self.base_url = f"{scheme}://{host}:{port}/sdapi/v1"
+        self.limit = limit
+        self._session: aiohttp.ClientSession | None = None
+        # webuiに今読み込まれているオプション。不明ならNone
+        self.current: Options | None = None
+        self.switch_count = 0
+        self.switch_seconds = 0.0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                # モデルの切り替えや生成は時間がかかるので全体のタイムアウトは設定しない
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+                trace_configs=[metrics.trace_config("webui")],
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
-    def get_current_options(self):
-        options = self.api.get_options()
+    async def _get(self, path: str):
+        async with self.session.get(self.base_url + path) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def _post(self, path: str, json: dict):
+        async with self.session.post(self.base_url + path, json=json) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def get_current_options(self):
+        options = await self._get("/options")
         return Options(
-            model=options["sd_model_checkpoint"],
+            model=_checkpoint_name(options["sd_model_checkpoint"]),
             vae=options["sd_vae"]
         )
 
-    def set_current_options(self, options: Options):
-        self.api.set_options({"sd_model_checkpoint": options.model, "sd_vae": options.vae})
+    async def set_current_options(self, options: Options):
+        self.current = None
+        await self._post(
+            "/options", {"sd_model_checkpoint": options.model, "sd_vae": options.vae}
+        )
+        self.current = Options(model=options.model, vae=options.vae)
+
+    async def refresh_options(self) -> Options:
+        """webuiから今のオプションを取り直す"""
+        try:
+            self.current = await self.get_current_options()
+        except Exception:
+            self.current = None
+            raise
+        return self.current
+
+    def invalidate_options(self):
+        """エラーなどで今のオプションが分からなくなったときに呼ぶ"""
+        self.current = None
+
+    async def ensure_options(self, options: Options) -> bool:
+        """今のオプションと違うときだけ切り替える。切り替えたらTrueを返す"""
+        if self.current is None:
+            try:
+                await self.refresh_options()
+            except Exception:
+                logger.warning("オプションの取得に失敗しました", exc_info=True)
+        if self.current == options:
+            return False
+
+        s_time = time.perf_counter()
+        try:
+            await self.set_current_options(options)
+        except Exception:
+            logger.warning("オプションの設定に失敗しました", exc_info=True)
+            try:
+                await self.refresh_options()
+            except Exception:
+                pass
+            raise
+        p_time = time.perf_counter() - s_time
+        self.switch_count += 1
+        self.switch_seconds += p_time
+        CHECKPOINT_SWITCHES.inc(self.base_url)
+        CHECKPOINT_SWITCH_SECONDS.observe(p_time, self.base_url)
+        logger.info(
+            f"モデルを{options.model}({options.vae})に切り替えました: {round(p_time, 2)}秒 "
+            f"(累計{self.switch_count}回, {round(self.switch_seconds, 2)}秒)"
+        )
+        return True
+
+    async def get_models(self):
+        return [i["model_name"] for i in await self._get("/sd-models")]
+
+    async def get_vaes(self):
+        return [i["model_name"] for i in await self._get("/sd-vae")]
+
+    async def get_embeddings(self):
+        return list((await self._get("/embeddings"))["loaded"].keys())
+
+    async def get_progress(self, skip_current_image: bool = True) -> Progress:
+        async with self.session.get(
+            self.base_url + "/progress",
+            params={"skip_current_image": str(skip_current_image).lower()},
+        ) as resp:
+            resp.raise_for_status()
+            r = await resp.json()
+        return Progress(
+            progress=r.get("progress", 0.0),
+            eta=r.get("eta_relative", 0.0),
+            image=r.get("current_image"),
+            job_count=r.get("state", {}).get("job_count", 0),
+        )
+
+    async def txt2img(self, **params) -> GenerationResult:
+        r = await self._post("/txt2img", params)
+        info = r.get("info", "{}")
+        return GenerationResult(
+            images=r["images"],
+            info=json.loads(info) if isinstance(info, str) else info,
+            parameters=r.get("parameters", params),
+        )
+
 
-    def get_models(self):
-        return [i["model_name"] for i in self.api.get_sd_models()]
+class CachedList:
+    """webuiから取得したリストをTTL付きで覚えておく
 
-    def get_vaes(self):
-        return [i["model_name"] for i in self.api.get_sd_vae()]
+    期限切れのときは古いリストをすぐ返し、裏で取り直す。
 
-    def get_embeddings(self):
-        return list(self.api.get_embeddings()["loaded"].keys())
+    Args:
+        fetch: リストを取得するコルーチン関数
+        ttl (float): 有効期限(秒)
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[list[str]]], ttl: float = 300) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self._index: CompletionEngine | None = None
+        self._fetched_at = 0.0
+        self._refreshing: asyncio.Task | None = None
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    async def get(self) -> CompletionEngine:
+        if self._index is None:
+            await self.refresh()
+            assert self._index is not None
+        elif self.expired:
+            self._refresh_in_background()
+        return self._index
+
+    async def refresh(self):
+        # 同時に呼ばれても取得は1回にする
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._fetch())
+        await asyncio.shield(self._refreshing)
+
+    def peek(self) -> CompletionEngine | None:
+        """取得済みのリストを返す。まだなければNone。ないか期限切れなら裏で取り直す"""
+        if self._index is None or self.expired:
+            self._refresh_in_background()
+        return self._index
+
+    def invalidate(self):
+        self._index = None
+        self._fetched_at = 0.0
+
+    def _refresh_in_background(self):
+        if self._refreshing is not None and not self._refreshing.done():
+            return
+        self._refreshing = asyncio.create_task(self._fetch())
+        self._refreshing.add_done_callback(_log_refresh_error)
+
+    async def _fetch(self):
+        items = await self.fetch()
+        self._index = CompletionEngine(items)
+        self._fetched_at = time.monotonic()
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("一覧の更新に失敗しました", exc_info=task.exception())
+
+
+class ListSource(Protocol):
+    """一覧を取得できるもの。ModelsAPIやBackendPool"""
+    async def get_models(self) -> list[str]: ...
+    async def get_vaes(self) -> list[str]: ...
+    async def get_embeddings(self) -> list[str]: ...
+
+
+class ModelCatalog:
+    """モデル、VAE、embeddingの一覧のキャッシュ
+
+    Args:
+        api (ListSource): 取得に使うAPI
+        ttl (float): 有効期限(秒)
+    """
+    def __init__(self, api: ListSource, ttl: float = 300) -> None:
+        self.models = CachedList(api.get_models, ttl)
+        self.vaes = CachedList(api.get_vaes, ttl)
+        self.embeddings = CachedList(api.get_embeddings, ttl)
+
+    def invalidate(self):
+        self.models.invalidate()
+        self.vaes.invalidate()
+        self.embeddings.invalidate()
+
+
+class BackendState(Enum):
+    WARMING_UP = "warming_up"
+    READY = "ready"
+    DOWN = "down"
+
+
+class SDBackend:
+    """webuiとの接続の状態を管理する
+
+    startしてもすぐに戻り、裏でwebuiに定期的に問い合わせる。
+    最初につながったときにデフォルトのオプションを設定し、一覧を取得しておく。
+
+    問い合わせは軽い/progressだけで行い、オプションは最初と失敗した後にだけ取り直す。
+    最初からmax_failures回続けてつながらなければDOWNにする。
+
+    Args:
+        api (ModelsAPI): webuiのAPI
+        interval (float): 問い合わせの間隔(秒)
+        max_failures (int): 準備中のまま何回失敗したらDOWNにするか
+    """
+    def __init__(self, api: ModelsAPI, interval: float = 15, max_failures: int = 3) -> None:
+        self.api = api
+        self.catalog = ModelCatalog(api)
+        self.interval = interval
+        self.max_failures = max_failures
+        self.state = BackendState.WARMING_UP
+        # 最後に問い合わせたときにwebuiで処理中だったジョブの数
+        self.remote_jobs = 0
+        self.failures = 0
+        self._initialized = False
+        self._task: asyncio.Task | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state is BackendState.READY
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.api.close()
+
+    async def probe(self):
+        try:
+            self.remote_jobs = (await self.api.get_progress()).job_count
+            if not self._initialized:
+                await self.api.ensure_options(Defaults.to_options())
+                await asyncio.gather(self.catalog.models.refresh(), self.catalog.vaes.refresh())
+                self._initialized = True
+        except Exception as e:
+            self.failures += 1
+            # つながらない間に別のクライアントが切り替えているかもしれない
+            self.api.invalidate_options()
+            if self.state is BackendState.READY:
+                logger.warning(f"webuiに接続できなくなりました: {e!r}")
+                self.state = BackendState.DOWN
+            elif self.state is BackendState.WARMING_UP and self.failures >= self.max_failures:
+                logger.warning(f"webuiに接続できません: {e!r}")
+                self.state = BackendState.DOWN
+            return
+        self.failures = 0
+        if self.state is not BackendState.READY:
+            logger.info("webuiに接続しました")
+        self.state = BackendState.READY
+
+    async def _run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+
+
+def _checkpoint_name(title: str) -> str:
+    """``HimawariMix-v8.safetensors [1a2b3c4d]`` のようなタイトルを/sd-modelsのmodel_nameにする"""
+    name = title.split(" [", 1)[0]
+    for ext in (".safetensors", ".ckpt", ".pt"):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
 
 
 def _format_name(name: str, upper: bool = True) -> str:
@@ -100,3 +436,6 @@ def _format_name(name: str, upper: bool = True) -> str:
 
 def make_choices(choices: list):
     return [ac.Choice(name=i, value=i) for i in choices]
+
+
+PORT = 7861